@@ -0,0 +1,365 @@
+import asyncio
+import copy
+import json
+import logging
+import random
+import re
+import threading
+import time
+from collections import OrderedDict
+from functools import partial
+
+from .metrics import timed
+
+logger = logging.getLogger("pretix_quickpay")
+
+# Base URL of the provider's API, ``None`` for the library's default. Tests and
+# benchmarks point this to a local server.
+API_BASE_URL = None
+# Number of keep-alive connections kept open per credential. Requests beyond this
+# limit wait for a free connection instead of opening additional ones.
+POOL_MAXSIZE = 10
+# Number of credentials (i.e. merchant accounts) we keep a pooled client around for.
+MAX_CLIENTS = 64
+# Seconds to wait for a connection to the provider and for its response
+CONNECT_TIMEOUT = 5
+READ_TIMEOUT = 20
+# Safe calls are retried this many times with jittered exponential backoff, as long
+# as the whole call including retries stays within its deadline (in seconds).
+MAX_RETRIES = 2
+RETRY_BACKOFF = 0.25
+CALL_DEADLINE = 30
+# HTTP methods supported by the client library, as ``QPClient.METHODS``
+HTTP_METHODS = ("get", "post", "put", "patch", "delete")
+# HTTP methods that can be repeated without side effects
+RETRYABLE_METHODS = ("get", "put")
+# After this many consecutive failed calls with a credential we stop calling the
+# provider with it for a while and fail fast instead.
+CIRCUIT_BREAKER_THRESHOLD = 5
+CIRCUIT_BREAKER_RESET_TIMEOUT = 30
+
+_clients = OrderedDict()
+_clients_lock = threading.Lock()
+# Timeouts of the current attempt of this thread, capped to the call's deadline
+_attempt_timeout = threading.local()
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class CircuitBreaker:
+    """Opens after ``threshold`` consecutive failures.
+
+    While open, calls fail right away. After ``reset_timeout`` seconds a
+    single trial call is let through, which closes the circuit again if
+    it succeeds.
+    """
+
+    def __init__(self, threshold, reset_timeout):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.lock = threading.Lock()
+
+    def before_call(self):
+        with self.lock:
+            if self.opened_at is None:
+                return
+            if time.monotonic() - self.opened_at < self.reset_timeout:
+                raise CircuitOpenError(
+                    "The payment provider is currently not reachable."
+                )
+            # Let this call through as a trial, others keep failing fast meanwhile
+            self.opened_at = time.monotonic()
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.failures >= self.threshold:
+                if self.opened_at is None:
+                    logger.warning(
+                        "Payment provider failed %d times in a row, pausing calls",
+                        self.failures,
+                    )
+                self.opened_at = time.monotonic()
+
+
+def _remaining_timeout(deadline):
+    """Returns the connect and read timeouts for an attempt, capped to the time
+    left until ``deadline``."""
+    remaining = max(deadline - time.monotonic(), 0.001)
+    return min(CONNECT_TIMEOUT, remaining), min(READ_TIMEOUT, remaining)
+
+
+def _fulfill(session, method, *args, **kwargs):
+    timeout = getattr(_attempt_timeout, "value", None)
+    if timeout is not None:
+        kwargs["timeout"] = timeout
+    return getattr(session, method)(*args, **kwargs)
+
+
+def _retry_delay(e, is_transient, breaker, attempt, retries, deadline):
+    """Records the failed attempt with the circuit breaker and returns the
+    number of seconds to wait before the next attempt, or ``None`` if the call
+    should fail.
+
+    Shared by the sync and asyncio clients.
+    """
+    if not is_transient(e):
+        # The provider answered, it's just not happy with our request
+        breaker.record_success()
+        return None
+    if not _is_rate_limited(e):
+        # Rate limits apply to this merchant account only and say nothing about
+        # the provider's health
+        breaker.record_failure()
+    delay = random.uniform(0, RETRY_BACKOFF * 2**attempt)
+    if attempt >= retries or time.monotonic() + delay >= deadline:
+        return None
+    return delay
+
+
+def _is_transient(e):
+    from quickpay_api_client.exceptions import ApiError
+    from requests.exceptions import ConnectionError, Timeout
+
+    if isinstance(e, (ConnectionError, Timeout)):
+        return True
+    if isinstance(e, ApiError):
+        return e.status_code >= 500 or _is_rate_limited(e)
+    return False
+
+
+def _is_rate_limited(e):
+    return getattr(e, "status_code", None) == 429
+
+
+def _is_unsent(e):
+    """Returns whether the failed request provably never reached the provider,
+    e.g. because the circuit was open or the connection was refused."""
+    from requests.exceptions import ConnectionError, ConnectTimeout
+    from urllib3.exceptions import NewConnectionError
+
+    if isinstance(e, (CircuitOpenError, ConnectTimeout)):
+        return True
+    if isinstance(e, ConnectionError) and e.args:
+        return isinstance(getattr(e.args[0], "reason", None), NewConnectionError)
+    return False
+
+
+class ProviderClient:
+    """Wraps a ``QPClient`` with the same interface (``client.get(path, ...)``
+    etc.) and adds timeouts, retries of safe calls, the circuit breaker of its
+    credential and metrics."""
+
+    def __init__(self, client, labels=None, breaker=None):
+        self.client = client
+        self.api = client.api
+        self.labels = labels or {"brand": "", "method": ""}
+        self.breaker = breaker or CircuitBreaker(
+            CIRCUIT_BREAKER_THRESHOLD, CIRCUIT_BREAKER_RESET_TIMEOUT
+        )
+
+    def labelled(self, brand, method=""):
+        """Returns a client sharing this client's connections whose calls are
+        recorded in the metrics with the given brand and payment method."""
+        return ProviderClient(
+            self.client, {"brand": brand, "method": method}, self.breaker
+        )
+
+    def __getattr__(self, method):
+        if method in HTTP_METHODS:
+            return partial(self.request, method)
+        raise AttributeError("unsupported http method: %s" % method)
+
+    def request(self, method, path, **kwargs):
+        labels = dict(self.labels)
+        labels["endpoint"] = "{} {}".format(
+            method.upper(), re.sub(r"/\d+", "/{id}", path)
+        )
+        with timed("provider_request", **labels):
+            return self._request(method, path, **kwargs)
+
+    def _request(self, method, path, **kwargs):
+        deadline = time.monotonic() + CALL_DEADLINE
+        retries = MAX_RETRIES if method in RETRYABLE_METHODS else 0
+        attempt = 0
+        while True:
+            self.breaker.before_call()
+            _attempt_timeout.value = _remaining_timeout(deadline)
+            try:
+                result = getattr(self.client, method)(path, **kwargs)
+            except Exception as e:
+                delay = _retry_delay(
+                    e, _is_transient, self.breaker, attempt, retries, deadline
+                )
+                if delay is None:
+                    raise
+                attempt += 1
+                logger.info(
+                    "Retrying %s %s after transient error: %s", method.upper(), path, e
+                )
+                time.sleep(delay)
+            else:
+                self.breaker.record_success()
+                return result
+            finally:
+                _attempt_timeout.value = None
+
+
+def _create_client(auth_token):
+    # The client library pulls in requests and its dependencies, which workers that
+    # never talk to the provider don't need to load.
+    from quickpay_api_client import QPClient
+    from requests.adapters import HTTPAdapter
+
+    client = QPClient(auth_token, API_BASE_URL)
+    client.api.timeout = (CONNECT_TIMEOUT, READ_TIMEOUT)
+    client.api.fulfill = partial(_fulfill, client.api.session)
+    adapter = HTTPAdapter(
+        pool_connections=1, pool_maxsize=POOL_MAXSIZE, pool_block=True
+    )
+    client.api.session.mount("https://", adapter)
+    client.api.session.mount("http://", adapter)
+    return ProviderClient(client)
+
+
+def get_client(apikey):
+    """Returns a client for the given API key that is shared across requests
+    and threads of this process, so connections to the provider are kept alive
+    and reused instead of doing a new TCP and TLS handshake for every call."""
+    auth_token = ":{0}".format(apikey)
+    with _clients_lock:
+        client = _clients.get(auth_token)
+        if client is None:
+            client = _create_client(auth_token)
+            _clients[auth_token] = client
+            if len(_clients) > MAX_CLIENTS:
+                _clients.popitem(last=False)
+        else:
+            _clients.move_to_end(auth_token)
+    return client
+
+
+class AsyncProviderClient:
+    """
+    asyncio counterpart of ``ProviderClient`` for workers that talk to the provider a
+    lot, e.g. bulk reconciliation. Uses the same authentication, endpoints, retries,
+    circuit breaker (shared with the pooled client of the same API key) and metrics,
+    but many requests can be in flight concurrently in a single thread. Requires ``aiohttp`` (``pip install pretix-quickpay[async]``)::
+
+        async with AsyncProviderClient(apikey) as client:
+            payment = await client.get("/payments/%s" % payment_id)
+    """
+
+    def __init__(self, apikey, labels=None, limit=POOL_MAXSIZE):
+        import aiohttp
+
+        self.aiohttp = aiohttp
+        self.apikey = apikey
+        self.labels = labels or {"brand": "", "method": ""}
+        self.limit = limit
+        self.breaker = get_client(apikey).breaker
+        self.session = None
+
+    async def __aenter__(self):
+        from quickpay_api_client import __version__
+        from quickpay_api_client.api import QPApi
+
+        self.session = self.aiohttp.ClientSession(
+            base_url=API_BASE_URL or QPApi.base_url,
+            auth=self.aiohttp.BasicAuth("", self.apikey),
+            headers={
+                "Accept-Version": "v%s" % QPApi.api_version,
+                "User-Agent": "quickpay-python-client, v%s" % __version__,
+            },
+            connector=self.aiohttp.TCPConnector(limit=self.limit),
+            timeout=self.aiohttp.ClientTimeout(
+                connect=CONNECT_TIMEOUT, sock_read=READ_TIMEOUT
+            ),
+        )
+        return self
+
+    async def __aexit__(self, *args):
+        await self.session.close()
+
+    def labelled(self, brand, method=""):
+        """Returns a client sharing this client's session whose calls are
+        recorded in the metrics with the given brand and payment method."""
+        client = copy.copy(self)
+        client.labels = {"brand": brand, "method": method}
+        return client
+
+    def __getattr__(self, method):
+        if method in HTTP_METHODS:
+            return partial(self.request, method)
+        raise AttributeError("unsupported http method: %s" % method)
+
+    async def request(self, method, path, **kwargs):
+        labels = dict(self.labels)
+        labels["endpoint"] = "{} {}".format(
+            method.upper(), re.sub(r"/\d+", "/{id}", path)
+        )
+        with timed("provider_request", **labels):
+            return await self._request(method, path, **kwargs)
+
+    async def _request(self, method, path, body=None, query=None, raw=False):
+        deadline = time.monotonic() + CALL_DEADLINE
+        retries = MAX_RETRIES if method in RETRYABLE_METHODS else 0
+        attempt = 0
+        while True:
+            self.breaker.before_call()
+            try:
+                result = await self._perform(
+                    method, path, body, query, raw, _remaining_timeout(deadline)
+                )
+            except Exception as e:
+                delay = _retry_delay(
+                    e, self._is_transient, self.breaker, attempt, retries, deadline
+                )
+                if delay is None:
+                    raise
+                attempt += 1
+                logger.info(
+                    "Retrying %s %s after transient error: %s", method.upper(), path, e
+                )
+                await asyncio.sleep(delay)
+            else:
+                self.breaker.record_success()
+                return result
+
+    async def _perform(self, method, path, body, query, raw, timeout):
+        from quickpay_api_client.exceptions import ApiError
+
+        connect_timeout, read_timeout = timeout
+        async with self.session.request(
+            method,
+            path,
+            json=body if method in ("put", "post", "patch") else None,
+            params=query,
+            timeout=self.aiohttp.ClientTimeout(
+                total=read_timeout, connect=connect_timeout, sock_read=read_timeout
+            ),
+        ) as response:
+            text = await response.text()
+            if response.headers.get("content-type") == "application/json":
+                result = json.loads(text)
+            else:
+                result = text
+            if response.status >= 400:
+                raise ApiError(result, response.status)
+            if raw:
+                return [response.status, text, response.headers]
+            return result
+
+    def _is_transient(self, e):
+        if isinstance(e, (self.aiohttp.ClientConnectionError, asyncio.TimeoutError)):
+            return True
+        return _is_transient(e)
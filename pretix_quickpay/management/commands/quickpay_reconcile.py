@@ -0,0 +1,154 @@
+import time
+from collections import defaultdict
+from datetime import timedelta
+from django.core.management.base import BaseCommand
+from django.utils.timezone import now
+from django_scopes import scopes_disabled
+from pretix.base.models import Event, OrderPayment
+from pretix.base.settings import SettingsSandbox
+
+from pretix_quickpay.reconciliation import (
+    pending_payments,
+    reconcile_payments,
+    sync_payments_by_listing,
+)
+from pretix_quickpay.registry import methods_by_identifier
+
+
+class Command(BaseCommand):
+    help = (
+        "Fetch the current state of all created or pending Quickpay and Unzer Direct "
+        "payments, and of payments with refunds in transit, from the provider and "
+        "apply it, e.g. to recover lost callbacks."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--organizer", help="Only payments of this organizer")
+        parser.add_argument("--event", help="Only payments of this event")
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=8,
+            help="Number of concurrent requests to the provider",
+        )
+        parser.add_argument(
+            "--rate",
+            type=float,
+            default=10,
+            help="Maximum number of requests to the provider per second",
+        )
+        parser.add_argument(
+            "--asyncio",
+            action="store_true",
+            help="Run the concurrent requests on an asyncio event loop instead of "
+            "worker threads (requires aiohttp)",
+        )
+        parser.add_argument(
+            "--listing",
+            action="store_true",
+            help="Page through the provider's payment list instead of fetching every "
+            "open payment on its own. This also updates payments in any state.",
+        )
+        parser.add_argument(
+            "--days",
+            type=int,
+            default=1,
+            help="With --listing, sync payments created within this many days",
+        )
+
+    @scopes_disabled()
+    def handle(self, *args, **options):
+        # Make sure all payment methods are registered
+        import pretix_quickpay.paymentmethods  # NOQA
+        import pretix_unzerdirect.paymentmethods  # NOQA
+
+        if options["listing"]:
+            return self.handle_listing(options)
+
+        payments = pending_payments()
+        if options["organizer"]:
+            payments = payments.filter(
+                order__event__organizer__slug=options["organizer"]
+            )
+        if options["event"]:
+            payments = payments.filter(order__event__slug=options["event"])
+
+        total = payments.count()
+        start = time.monotonic()
+        self.stdout.write(f"Reconciling {total} payments…")
+
+        def progress(stats):
+            self.stdout.write(
+                "{total}/{count} done, {changed} changed, {failed} failed, "
+                "{skipped} skipped ({elapsed:.1f}s)".format(
+                    count=total, elapsed=time.monotonic() - start, **stats
+                )
+            )
+
+        stats = reconcile_payments(
+            payments.iterator(),
+            workers=options["workers"],
+            rate=options["rate"],
+            progress=progress,
+            use_asyncio=options["asyncio"],
+        )
+        elapsed = time.monotonic() - start
+        self.stdout.write(
+            self.style.SUCCESS(
+                "Reconciled {total} payments in {elapsed:.1f}s "
+                "({changed} changed, {failed} failed, {skipped} skipped)".format(
+                    elapsed=elapsed, **stats
+                )
+            )
+        )
+
+    def handle_listing(self, options):
+        since = now() - timedelta(days=options["days"])
+        payments = OrderPayment.objects.filter(
+            provider__in=list(methods_by_identifier), created__gte=since
+        )
+        if options["organizer"]:
+            payments = payments.filter(
+                order__event__organizer__slug=options["organizer"]
+            )
+        if options["event"]:
+            payments = payments.filter(order__event__slug=options["event"])
+
+        # Only brands an event has payments of are synced, and events that share a
+        # merchant account are synced with a single listing
+        brands = {
+            (event_id, provider.split("_")[0])
+            for event_id, provider in payments.order_by()
+            .values_list("order__event", "provider")
+            .distinct()
+        }
+        events = Event.objects.in_bulk({event_id for event_id, brand in brands})
+        accounts = defaultdict(list)
+        for event_id, brand in sorted(brands):
+            apikey = SettingsSandbox("payment", brand, events[event_id]).get("apikey")
+            if apikey:
+                accounts[(brand, apikey)].append(events[event_id])
+
+        start = time.monotonic()
+        for (brand, apikey), account_events in accounts.items():
+            slugs = ", ".join(event.slug for event in account_events)
+            try:
+                stats = sync_payments_by_listing(account_events, brand, since)
+            except Exception as e:
+                self.stderr.write(f"{slugs} ({brand}): {e}")
+                continue
+            if stats["total"]:
+                self.stdout.write(
+                    "{events} ({brand}): {total} listed, {matched} matched, "
+                    "{changed} changed ({elapsed:.1f}s)".format(
+                        events=slugs,
+                        brand=brand,
+                        elapsed=time.monotonic() - start,
+                        **stats,
+                    )
+                )
+        self.stdout.write(
+            self.style.SUCCESS(
+                "Synced payments in {:.1f}s".format(time.monotonic() - start)
+            )
+        )
@@ -0,0 +1,67 @@
+import time
+from django.core.management.base import BaseCommand
+from django_scopes import scopes_disabled
+
+from pretix_quickpay.reconciliation import execute_refunds, pending_refunds
+
+
+class Command(BaseCommand):
+    help = (
+        "Submit all refunds of Quickpay and Unzer Direct payments that are waiting "
+        "to be executed to the provider, e.g. after an event has been cancelled."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--organizer", help="Only refunds of this organizer")
+        parser.add_argument("--event", help="Only refunds of this event")
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=8,
+            help="Number of concurrent requests to the provider",
+        )
+        parser.add_argument(
+            "--rate",
+            type=float,
+            default=10,
+            help="Maximum number of requests per second for each merchant account",
+        )
+
+    @scopes_disabled()
+    def handle(self, *args, **options):
+        # Make sure all payment methods are registered
+        import pretix_quickpay.paymentmethods  # NOQA
+        import pretix_unzerdirect.paymentmethods  # NOQA
+
+        refunds = pending_refunds()
+        if options["organizer"]:
+            refunds = refunds.filter(order__event__organizer__slug=options["organizer"])
+        if options["event"]:
+            refunds = refunds.filter(order__event__slug=options["event"])
+
+        total = refunds.count()
+        start = time.monotonic()
+        self.stdout.write(f"Executing {total} refunds…")
+
+        def progress(stats):
+            self.stdout.write(
+                "{total}/{count} done, {accepted} accepted, {failed} failed, "
+                "{errors} errors, {unsent} not sent, {skipped} skipped "
+                "({elapsed:.1f}s)".format(
+                    count=total, elapsed=time.monotonic() - start, **stats
+                )
+            )
+
+        stats = execute_refunds(
+            refunds.iterator(),
+            workers=options["workers"],
+            rate=options["rate"],
+            progress=progress,
+        )
+        self.stdout.write(
+            self.style.SUCCESS(
+                "Executed {total} refunds in {elapsed:.1f}s ({accepted} accepted, "
+                "{failed} failed, {errors} errors, {unsent} not sent, "
+                "{skipped} skipped)".format(elapsed=time.monotonic() - start, **stats)
+            )
+        )
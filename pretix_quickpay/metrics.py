@@ -0,0 +1,78 @@
+import logging
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger("pretix_quickpay")
+
+
+class MetricsSink:
+    """Receives timings and counts of the plugin's hot paths.
+
+    Subclass this and pass an instance to ``set_sink`` to export them
+    somewhere else.
+    """
+
+    def observe(self, name, value, labels):
+        pass
+
+    def inc(self, name, labels):
+        pass
+
+
+class PretixMetricsSink(MetricsSink):
+    """Exports through pretix's Prometheus-style metrics, which are only
+    recorded if metrics are enabled in pretix's configuration."""
+
+    def __init__(self):
+        self.metrics = {}
+
+    def _get(self, cls, name, labels):
+        if name not in self.metrics:
+            self.metrics[name] = cls(name, name.replace("_", " "), sorted(labels))
+        return self.metrics[name]
+
+    def observe(self, name, value, labels):
+        from pretix.base.metrics import Histogram
+
+        self._get(Histogram, name, labels).observe(value, **labels)
+
+    def inc(self, name, labels):
+        from pretix.base.metrics import Counter
+
+        self._get(Counter, name, labels).inc(1, **labels)
+
+
+sink = PretixMetricsSink()
+
+
+def set_sink(new_sink: MetricsSink):
+    global sink
+    sink = new_sink
+
+
+@contextmanager
+def timed(name, **labels):
+    """Records the duration of the wrapped block as
+    ``pretix_quickpay_<name>_duration_seconds`` and counts it as
+    ``pretix_quickpay_<name>_total``, labelled with the given labels and an
+    ``outcome``.
+
+    The yielded dict can be used to set a more specific outcome than
+    ``success`` or ``error``.
+    """
+    result = {"outcome": "success"}
+    start = time.perf_counter()
+    try:
+        yield result
+    except Exception:
+        result["outcome"] = "error"
+        raise
+    finally:
+        duration = time.perf_counter() - start
+        labels = {k: str(v) for k, v in labels.items()}
+        labels["outcome"] = result["outcome"]
+        try:
+            sink.observe(f"pretix_quickpay_{name}_duration_seconds", duration, labels)
+            sink.inc(f"pretix_quickpay_{name}_total", labels)
+        except Exception:
+            logger.exception("Could not record metric %s", name)
@@ -2,39 +2,225 @@ from typing import Any, Dict, Union
 
 import hashlib
 import hmac
-import importlib
 import json
 import logging
+import time
+import uuid
 from collections import OrderedDict
+from contextlib import contextmanager
 from decimal import Decimal
+from django import forms
 from django.conf import settings
+from django.core.cache import cache
 from django.http import HttpRequest
 from django.template.loader import get_template
+from django.utils import translation
+from django.utils.dateparse import parse_datetime
 from django.utils.safestring import mark_safe
 from django.utils.timezone import now
 from django.utils.translation import gettext_lazy as _
+from functools import lru_cache
 from pretix.base.decimal import round_decimal
 from pretix.base.forms import SecretKeySettingsField
 from pretix.base.models import Event, Order, OrderPayment, OrderRefund
 from pretix.base.payment import BasePaymentProvider, PaymentException
 from pretix.base.settings import SettingsSandbox
-from pretix.multidomain.urlreverse import build_absolute_uri
-from quickpay_api_client import QPClient
+from pretix.multidomain.urlreverse import build_absolute_uri, eventreverse
+
+from .client import _is_unsent, get_client
+from .metrics import timed
+from .registry import card_methods_by_brand, methods_by_brand
 
 logger = logging.getLogger("pretix_quickpay")
 
+# Seconds for which an already processed callback with the same operations is ignored
+CALLBACK_DEDUPLICATION_TIMEOUT = 3600
+# Callback bodies larger than this many bytes are rejected without being read in full
+CALLBACK_MAX_SIZE = 1024 * 1024
+CALLBACK_READ_CHUNK_SIZE = 64 * 1024
+# Number of bytes of an invalid callback body that are logged
+CALLBACK_LOG_SIZE = 1024
+# Seconds for which another refresh of the same payment from the provider is skipped
+REFRESH_DEDUPLICATION_TIMEOUT = 5
+# Seconds after which a per-payment lock is considered stale. A holder calls the
+# provider for up to client.CALL_DEADLINE seconds and then handles the state change,
+# so this needs to be well above that.
+PAYMENT_LOCK_TIMEOUT = 120
+# Seconds we wait for the lock of a payment at most before giving up
+PAYMENT_LOCK_WAIT = 60
+PAYMENT_LOCK_POLL_INTERVAL = 0.1
+# Seconds for which a payment created at the provider while the customer is on the
+# confirm page is kept around to be used for their order
+PRECREATED_PAYMENT_TIMEOUT = 1800
+
+
+class PaymentLockTimeout(Exception):
+    pass
+
+
+@contextmanager
+def payment_lock(payment: OrderPayment):
+    """Serializes work on a payment across threads and processes through the
+    shared cache.
+
+    Raises ``PaymentLockTimeout`` if the lock cannot be acquired in
+    time.
+    """
+    key = f"pretix_quickpay:lock:{payment.pk}"
+    token = uuid.uuid4().hex
+    deadline = time.monotonic() + PAYMENT_LOCK_WAIT
+    while not cache.add(key, token, PAYMENT_LOCK_TIMEOUT):
+        if time.monotonic() >= deadline:
+            raise PaymentLockTimeout(
+                "Could not acquire lock for payment %s" % payment.pk
+            )
+        time.sleep(PAYMENT_LOCK_POLL_INTERVAL)
+    try:
+        yield
+    finally:
+        if cache.get(key) == token:
+            cache.delete(key)
+
+
+# Fields of the provider's payment object we keep in ``OrderPayment.info``
+COMPACT_PAYMENT_FIELDS = (
+    "id",
+    "order_id",
+    "currency",
+    "state",
+    "accepted",
+    "test_mode",
+    "acquirer",
+    "balance",
+    "created_at",
+    "updated_at",
+)
+
+
+def compact_payment_info(payment_info):
+    """Reduces a payment object of the provider to the fields this plugin
+    reads: Of the link only its URL and amount, and of the operations only the
+    last one and their count.
+
+    The full history remains available from the provider and in the log
+    entries of the callbacks.
+    """
+    if "id" not in payment_info:
+        return payment_info
+    operations = payment_info.get("operations") or []
+    compact = {k: payment_info[k] for k in COMPACT_PAYMENT_FIELDS if k in payment_info}
+    if payment_info.get("link"):
+        compact["link"] = {
+            k: payment_info["link"][k]
+            for k in ("url", "amount")
+            if k in payment_info["link"]
+        }
+    compact["operations"] = operations[-1:]
+    compact["operation_count"] = payment_info.get("operation_count", len(operations))
+    return compact
+
+
+def _operation_count(payment_info):
+    return payment_info.get("operation_count", len(payment_info.get("operations", [])))
+
+
+@lru_cache(maxsize=None)
+def _cached_template(template_name):
+    return get_template(template_name)
+
+
+def _get_template(template_name):
+    """Returns the compiled template, which is kept for the lifetime of the
+    process unless templates are reloaded in debug mode."""
+    if settings.DEBUG:
+        return get_template(template_name)
+    return _cached_template(template_name)
+
+
+@lru_cache(maxsize=64)
+def _render_static_template(template_name, language):
+    with translation.override(language):
+        return _get_template(template_name).render()
+
+
+def _render_static(template_name):
+    """Renders a template that does not depend on any context.
+
+    The output only differs by language, so it is rendered once per
+    language and process.
+    """
+    if settings.DEBUG:
+        return _get_template(template_name).render()
+    return _render_static_template(template_name, translation.get_language())
+
+
+def _callback_cache_key(payment: OrderPayment, data: dict):
+    operations_hash = hashlib.sha256(
+        json.dumps(
+            [data.get("state"), data.get("operations", [])], sort_keys=True
+        ).encode()
+    ).hexdigest()
+    return f"pretix_quickpay:callback:{payment.pk}:{operations_hash}"
+
+
+def _enabled_methods(event: Event, brand):
+    """Returns the set of payment methods enabled for the given brand.
+
+    pretix checks ``is_enabled`` for every provider on every checkout
+    page, so the result is memoized on the event object. pretix loads
+    the event for every request, so this is a per-request memo and
+    settings changes are picked up by the next request.
+    """
+    memo = getattr(event, "_pretix_quickpay_enabled_methods", None)
+    if memo is None:
+        memo = event._pretix_quickpay_enabled_methods = {}
+    if brand not in memo:
+        settings = SettingsSandbox("payment", brand, event)
+        if settings.get("_enabled", as_type=bool):
+            memo[brand] = frozenset(
+                m
+                for m in methods_by_brand.get(brand, {})
+                if settings.get("method_{}".format(m), as_type=bool)
+            )
+        else:
+            memo[brand] = frozenset()
+    return memo[brand]
+
 
 class QuickpaySettingsHolder(BasePaymentProvider):
     identifier = "quickpay_settings"
     verbose_name = _("Quickpay")
     is_enabled = False
     is_meta = True
-    payment_methods_settingsholder = []
+    # Descriptors of the payment methods offered by this brand
+    payment_method_descriptors = []
 
     def __init__(self, event: Event):
         super().__init__(event)
         self.settings = SettingsSandbox("payment", self.identifier.split("_")[0], event)
 
+    def _payment_method_fields(self):
+        return [
+            (
+                "method_{}".format(m["method"]),
+                forms.BooleanField(
+                    label="{} {}".format(
+                        (
+                            '<span class="fa fa-credit-card"></span>'
+                            if m["type"] in ["scheme", "meta"]
+                            else ""
+                        ),
+                        m["verbose_name"],
+                    ),
+                    help_text=_(
+                        "Needs to be enabled in your payment provider's account first. {m_help_text}"
+                    ).format(m_help_text=m.get("help_text", "")),
+                    required=False,
+                ),
+            )
+            for m in self.payment_method_descriptors
+        ]
+
     @property
     def settings_form_fields(self):
         fields = [
@@ -61,10 +247,23 @@ class QuickpaySettingsHolder(BasePaymentProvider):
                     ),
                 ),
             ),
+            (
+                "precreate_payments",
+                forms.BooleanField(
+                    label=_("Prepare payments in advance"),
+                    help_text=_(
+                        "Creates the payment at your payment provider while the customer reviews their order, "
+                        "so they are redirected faster after confirming it. Payments prepared this way are not "
+                        "labelled with the order code at your payment provider, and payments that are not "
+                        "completed remain there unused."
+                    ),
+                    required=False,
+                ),
+            ),
         ]
         d = OrderedDict(
             fields
-            + self.payment_methods_settingsholder
+            + self._payment_method_fields()
             + list(super().settings_form_fields.items())
         )
 
@@ -76,15 +275,23 @@ class QuickpayMethod(BasePaymentProvider):
     identifier = "quickpay"
     method = ""
     verbose_name = ""
+    # Currencies and order totals the method can be used for, None if unrestricted
+    currencies = None
+    min_amount = None
+    max_amount = None
+    # Apply the checksum-verified payment object of a callback directly instead of
+    # fetching it from the provider again, unless the order of events is unclear.
+    trust_callback_payload = True
 
     def __init__(self, event: Event):
         super().__init__(event)
         self.settings = SettingsSandbox("payment", self.identifier.split("_")[0], event)
 
+    def _metric_labels(self):
+        return {"brand": self.identifier.split("_")[0], "method": self.method}
+
     def _init_client(self):
-        auth_token = ":{0}".format(self.settings.get("apikey"))
-        client = QPClient(auth_token)
-        return client
+        return get_client(self.settings.get("apikey")).labelled(**self._metric_labels())
 
     @property
     def settings_form_fields(self):
@@ -92,35 +299,29 @@ class QuickpayMethod(BasePaymentProvider):
 
     @property
     def is_enabled(self) -> bool:
+        enabled_methods = _enabled_methods(self.event, self.identifier.split("_")[0])
         if self.type == "meta":
-            module = importlib.import_module(
-                __name__.replace("quickpay", self.identifier.split("_")[0]).replace(
-                    ".payment", ".paymentmethods"
-                )
+            return bool(
+                enabled_methods
+                & card_methods_by_brand.get(self.identifier.split("_")[0], frozenset())
             )
-            for method in list(
-                filter(
-                    lambda d: d["type"] in ["meta", "scheme"], module.payment_methods
-                )
-            ):
-                if self.settings.get("_enabled", as_type=bool) and self.settings.get(
-                    "method_{}".format(method["method"]), as_type=bool
-                ):
-                    return True
-            return False
         else:
-            return self.settings.get("_enabled", as_type=bool) and self.settings.get(
-                "method_{}".format(self.method), as_type=bool
-            )
+            return self.method in enabled_methods
 
     def is_allowed(self, request: HttpRequest, total: Decimal = None) -> bool:
+        if self.currencies is not None and self.event.currency not in self.currencies:
+            return False
+        if total is not None:
+            if self.min_amount is not None and total < self.min_amount:
+                return False
+            if self.max_amount is not None and total > self.max_amount:
+                return False
         return super().is_allowed(request, total)
 
     def payment_form_render(
         self, request: HttpRequest, total: Decimal, order: Order = None
     ) -> str:
-        template = get_template("pretix_quickpay/checkout_payment_form.html")
-        return template.render()
+        return _render_static("pretix_quickpay/checkout_payment_form.html")
 
     def payment_is_valid_session(self, request: HttpRequest) -> bool:
         return True
@@ -131,9 +332,94 @@ class QuickpayMethod(BasePaymentProvider):
         return True
 
     def checkout_confirm_render(self, request, order: Order = None) -> str:
-        template = get_template("pretix_quickpay/checkout_payment_confirm.html")
-        ctx = {"request": request}
-        return template.render(ctx)
+        if self.settings.get("precreate_payments", as_type=bool):
+            self._precreate_payment_for_session(request)
+        return _render_static("pretix_quickpay/checkout_payment_confirm.html")
+
+    def _precreated_payment_session_key(self):
+        return "payment_{}_{}_precreated".format(
+            self.identifier.split("_")[0], self.event.pk
+        )
+
+    def _precreated_payment_owner(self):
+        # The payment can only be used with the merchant account that created it
+        return {
+            "event": self.event.pk,
+            "apikey": hashlib.sha256(
+                (self.settings.get("apikey") or "").encode()
+            ).hexdigest(),
+        }
+
+    def _precreate_payment_for_session(self, request):
+        session_key = self._precreated_payment_session_key()
+        token = request.session.get(session_key)
+        if token and cache.get(f"pretix_quickpay:precreated:{token}") is not None:
+            # Already prepared or being prepared
+            return
+        token = uuid.uuid4().hex
+        key = f"pretix_quickpay:precreated:{token}"
+        cache.set(key, self._precreated_payment_owner(), PRECREATED_PAYMENT_TIMEOUT)
+        if cache.get(key) is None:
+            # Without a shared cache, execute_payment could never use the payment
+            return
+        request.session[session_key] = token
+        from .tasks import precreate_payment
+
+        precreate_payment.apply_async(
+            kwargs={
+                "event": self.event.pk,
+                "provider": self.identifier,
+                "token": token,
+            }
+        )
+
+    def precreate_payment(self, token):
+        """Creates a payment at the provider for the customer's upcoming order,
+        which ``execute_payment`` can use instead of creating one itself."""
+        key = f"pretix_quickpay:precreated:{token}"
+        try:
+            quickpay_payment = self._init_client().post(
+                "/payments",
+                body={
+                    "currency": self.event.currency,
+                    # The order does not exist yet, the provider requires a unique
+                    # reference of 4 to 20 characters.
+                    "order_id": "pre-{}".format(token[:16]),
+                },
+            )
+        except Exception as e:
+            logger.exception("Quickpay Payments error: %s" % e)
+            # Allows the next rendering of the confirm page to try again
+            cache.delete(key)
+            return
+        if cache.get(key) is None:
+            # The order has been placed in the meantime
+            return
+        cache.set(
+            key,
+            dict(self._precreated_payment_owner(), payment=quickpay_payment),
+            PRECREATED_PAYMENT_TIMEOUT,
+        )
+
+    def _pop_precreated_payment(self, request):
+        if request is None or not hasattr(request, "session"):
+            return None
+        token = request.session.pop(self._precreated_payment_session_key(), None)
+        if not token:
+            return None
+        key = f"pretix_quickpay:precreated:{token}"
+        entry = cache.get(key)
+        cache.delete(key)
+        if not entry or "payment" not in entry:
+            return None
+        owner = self._precreated_payment_owner()
+        if (
+            entry["event"] != owner["event"]
+            or entry["apikey"] != owner["apikey"]
+            or entry["payment"].get("currency") != self.event.currency
+        ):
+            return None
+        return entry["payment"]
 
     def test_mode_message(self) -> str:
         return mark_safe(
@@ -184,14 +470,22 @@ class QuickpayMethod(BasePaymentProvider):
             "payment_methods": self.method,
             "auto_capture": True,
         }
+        # The amount is only part of the link, so a payment prepared while the
+        # customer was on the confirm page fits as long as the currency does.
+        quickpay_payment = self._pop_precreated_payment(request)
         try:
-            # Create payment:
-            quickpay_payment = client.post("/payments", body=payment_data)
+            if quickpay_payment is None:
+                # Create payment:
+                quickpay_payment = client.post("/payments", body=payment_data)
             # Create Link for Authorization:
             link = client.put(
                 "/payments/%s/link" % quickpay_payment["id"], body=link_data
             )
-            payment.info_data = client.get("/payments/%s" % quickpay_payment["id"])
+            # The link response only contains the URL, so we merge in what we sent
+            # to avoid another round-trip. Anything else is filled in on the next
+            # refresh from the return view or callback.
+            quickpay_payment["link"] = dict(link_data, **link)
+            payment.info_data = compact_payment_info(quickpay_payment)
         except Exception as e:
             logger.exception("Quickpay Payments error: %s" % e)
             raise PaymentException(
@@ -216,19 +510,32 @@ class QuickpayMethod(BasePaymentProvider):
         return refund.info_data.get("id", None)
 
     def payment_pending_render(self, request, payment) -> str:
-        template = get_template("pretix_quickpay/pending.html")
+        template = _get_template("pretix_quickpay/pending.html")
         operations = payment.info_data.get("operations", [])
+        ident = self.identifier.split("_")[0]
         ctx = {
             "payment_info": payment.info_data,
             "payment": payment,
             "operation": operations[-1] if len(operations) > 0 else None,
+            "status_url": eventreverse(
+                self.event,
+                "plugins:pretix_{}:status".format(ident),
+                kwargs={
+                    "order": payment.order.code,
+                    "hash": hashlib.sha1(
+                        payment.order.secret.lower().encode()
+                    ).hexdigest(),
+                    "payment": payment.pk,
+                    "payment_provider": ident,
+                },
+            ),
         }
         return template.render(ctx)
 
     def payment_control_render(
         self, request: HttpRequest, payment: OrderPayment
     ) -> str:
-        template = get_template("pretix_quickpay/control.html")
+        template = _get_template("pretix_quickpay/control.html")
         ctx = {
             "request": request,
             "event": self.event,
@@ -267,16 +574,82 @@ class QuickpayMethod(BasePaymentProvider):
             return True
         return False
 
-    def execute_refund(self, refund: OrderRefund):
-        client = self._init_client()
+    def _request_refund(self, client, refund: OrderRefund):
+        from quickpay_api_client.exceptions import ApiError
+
         try:
             status, body, headers = client.post(
                 "/payments/%s/refund" % refund.payment.info_data.get("id"),
                 body={"amount": self._decimal_to_int(refund.amount)},
                 raw=True,
             )
+        except ApiError as e:
+            if e.status_code >= 500:
+                raise
+            # The client raises for rejected requests, we treat them like answers
+            status = e.status_code
+            body = json.dumps(
+                e.body if isinstance(e.body, dict) else {"message": e.body}
+            )
+        return status, body
+
+    def _apply_refund_response(self, refund: OrderRefund, status, body):
+        """Updates the refund with the provider's answer to the refund request
+        without saving it.
+
+        Returns the fields that need to be saved.
+        """
+        response = json.loads(body)
+        refund.info_data = compact_payment_info(response)
+        # OK, the refund is accepted and its outcome is reported through the callback
+        if status == 202:
+            operations = [
+                op
+                for op in response.get("operations", [])
+                if op.get("type") == "refund"
+            ]
+            if operations:
+                refund.info_data["refund_operation_id"] = operations[-1].get("id")
+            refund.state = OrderRefund.REFUND_STATE_TRANSIT
+            return ["state", "info"]
+        # Error || Invalid parameters or Not authorized
+        refund.state = OrderRefund.REFUND_STATE_FAILED
+        refund.execution_date = now()
+        return ["state", "execution_date", "info"]
+
+    def _claim_refund(self, refund: OrderRefund):
+        """Moves a created refund to transit before it is submitted to the
+        provider, so that it is only submitted once even if several processes
+        execute refunds.
+
+        Returns whether the refund was claimed.
+        """
+        claimed = OrderRefund.objects.filter(
+            pk=refund.pk, state=OrderRefund.REFUND_STATE_CREATED
+        ).update(state=OrderRefund.REFUND_STATE_TRANSIT)
+        if claimed:
+            refund.state = OrderRefund.REFUND_STATE_TRANSIT
+        return bool(claimed)
+
+    def _release_refund(self, refund: OrderRefund):
+        """Moves a claimed refund back to created after its request provably
+        did not reach the provider, so that it can be submitted again."""
+        OrderRefund.objects.filter(
+            pk=refund.pk, state=OrderRefund.REFUND_STATE_TRANSIT
+        ).update(state=OrderRefund.REFUND_STATE_CREATED)
+        refund.state = OrderRefund.REFUND_STATE_CREATED
+
+    def execute_refund(self, refund: OrderRefund):
+        if not self._claim_refund(refund):
+            logger.info("Refund %s is already being executed", refund.full_id)
+            return
+        client = self._init_client()
+        try:
+            status, body = self._request_refund(client, refund)
         except Exception as e:
             logger.exception("Quickpay Payments error: %s" % e)
+            if _is_unsent(e):
+                self._release_refund(refund)
             raise PaymentException(
                 _(
                     "We had trouble communicating with the payment provider. Please try again and get in touch "
@@ -284,22 +657,12 @@ class QuickpayMethod(BasePaymentProvider):
                 )
             )
 
-        # OK
-        if status == 202:
-            refund.info_data = json.loads(body)
-            refund.save(update_fields=["info"])
-            refund.done()
-        # Error || Invalid parameters or Not authorized
-        elif status == 400 or status == 403:
-            refund.state = OrderRefund.REFUND_STATE_FAILED
-            refund.execution_date = now()
-            refund.info_data = json.loads(body)
-            refund.save(update_fields=["state", "execution_date", "info"])
-        else:
-            refund.state = OrderRefund.REFUND_STATE_FAILED
-            refund.execution_date = now()
-            refund.info_data = json.loads(body)
-            refund.save(update_fields=["state", "execution_date", "info"])
+        refund.save(update_fields=self._apply_refund_response(refund, status, body))
+        if refund.state == OrderRefund.REFUND_STATE_TRANSIT:
+            # In case the provider already finished the refund operation
+            self._handle_refund_operations(
+                refund.payment, refund.info_data.get("operations", [])
+            )
 
     def refund_control_render(self, request: HttpRequest, refund: OrderRefund) -> str:
         return self.payment_control_render(request, refund)
@@ -312,60 +675,267 @@ class QuickpayMethod(BasePaymentProvider):
         places = settings.CURRENCY_PLACES.get(self.event.currency, 2)
         return int(amount * 10**places)
 
-    def _handle_state_change(self, payment: OrderPayment):
-        state = payment.info_data.get("state")
-        if state == "rejected":
-            payment.fail()
-        elif state == "pending":
-            payment.state = OrderPayment.PAYMENT_STATE_PENDING
-            payment.save(update_fields=["state"])
-        elif state == "processed":
-            if payment.info_data.get("balance") == self._decimal_to_int(payment.amount):
-                if payment.info_data.get("test_mode") == payment.order.testmode:
-                    payment.confirm()
-                else:
-                    payment.fail()
-            else:
-                operations = payment.info_data.get("operations", "")
-                for operation in operations:
-                    if (
-                        operation.get("type") == "capture"
-                        and int(operation.get("qp_status_code")) >= 40000
-                    ):
+    def _handle_state_change(self, payment: OrderPayment, payment_info=None):
+        payment_info = payment_info or payment.info_data
+        state = payment_info.get("state")
+        with timed("state_change", state=state, **self._metric_labels()):
+            if state == "rejected":
+                payment.fail()
+            elif state == "pending":
+                payment.state = OrderPayment.PAYMENT_STATE_PENDING
+                payment.save(update_fields=["state"])
+            elif state == "processed":
+                if payment_info.get("balance") == self._decimal_to_int(payment.amount):
+                    if payment_info.get("test_mode") == payment.order.testmode:
+                        payment.confirm()
+                    else:
                         payment.fail()
+                else:
+                    operations = payment_info.get("operations", "")
+                    for operation in operations:
+                        if (
+                            operation.get("type") == "capture"
+                            and int(operation.get("qp_status_code")) >= 40000
+                        ):
+                            payment.fail()
+
+    def _read_callback_body(self, request: HttpRequest):
+        """Reads the body of a callback in chunks while computing its checksum.
+
+        Returns the body and the checksum, or ``None`` and ``None`` if
+        it is too large.
+        """
+        try:
+            content_length = int(request.META.get("CONTENT_LENGTH") or 0)
+        except ValueError:
+            content_length = 0
+        if content_length > CALLBACK_MAX_SIZE:
+            return None, None
+        checksum = hmac.new(
+            self.settings.get("privatekey").encode("UTF-8"), digestmod=hashlib.sha256
+        )
+        chunks = []
+        size = 0
+        while True:
+            chunk = request.read(CALLBACK_READ_CHUNK_SIZE)
+            if not chunk:
+                break
+            size += len(chunk)
+            if size > CALLBACK_MAX_SIZE:
+                return None, None
+            checksum.update(chunk)
+            chunks.append(chunk)
+        return b"".join(chunks), checksum.hexdigest()
 
     def handle_callback(self, request: HttpRequest, payment: OrderPayment):
-        # Checksum validation
-        request_body = request.body
-        checksum = hmac.new(
-            self.settings.get("privatekey").encode("UTF-8"),
-            request_body,
-            hashlib.sha256,
-        ).hexdigest()
-        validated = checksum == request.headers.get("QuickPay-Checksum-Sha256")
-        if validated:
-            payment.order.log_action(
-                f"pretix_{self.identifier.split('_')[0]}.event",
-                data=json.loads(request.body.decode("utf-8")),
+        with timed("callback", **self._metric_labels()) as metric:
+            request_body, checksum = self._read_callback_body(request)
+            if request_body is None:
+                metric["outcome"] = "too_large"
+                logger.warning(
+                    "Quickpay Callback for payment %s exceeds %d bytes",
+                    payment.pk,
+                    CALLBACK_MAX_SIZE,
+                )
+                return
+            # Checksum validation
+            if not hmac.compare_digest(
+                checksum.encode(),
+                request.headers.get("QuickPay-Checksum-Sha256", "").encode(),
+            ):
+                metric["outcome"] = "invalid"
+                logger.warning(
+                    "Quickpay Callback with invalid checksum (%d bytes): %r",
+                    len(request_body),
+                    request_body[:CALLBACK_LOG_SIZE],
+                )
+                return
+            try:
+                # The payload is parsed once, the task logs and processes this result
+                data = json.loads(request_body)
+            except ValueError:
+                data = None
+            if not isinstance(data, dict):
+                metric["outcome"] = "invalid"
+                logger.warning(
+                    "Quickpay Callback with invalid payload (%d bytes): %r",
+                    len(request_body),
+                    request_body[:CALLBACK_LOG_SIZE],
+                )
+                return
+            # Retried and repeated notifications carry the same operations, we only
+            # need to process the first one of them.
+            if cache.get(_callback_cache_key(payment, data)) is not None:
+                metric["outcome"] = "duplicate"
+                return
+            from .tasks import process_callback
+
+            # Reconciling with the provider happens in the background, so we can
+            # acknowledge the callback right away.
+            process_callback.apply_async(
+                kwargs={
+                    "event": self.event.pk,
+                    "payment": payment.pk,
+                    "data": data,
+                }
             )
-            self.get_current_payment(payment)
-        else:
-            logger.warning("Quickpay Callback with invalid checksum: %s", request_body)
+
+    def _is_newer_payment_info(self, current, new):
+        """Returns ``True`` if ``new`` is a more recent state of the payment
+        than ``current``, ``False`` if it is older or the same, and ``None`` if
+        the order cannot be told from the data."""
+        if not current.get("id") or current.get("id") != new.get("id"):
+            return None
+        current_ops = _operation_count(current)
+        new_ops = _operation_count(new)
+        if new_ops != current_ops:
+            return new_ops > current_ops
+        current_updated = parse_datetime(current.get("updated_at") or "")
+        new_updated = parse_datetime(new.get("updated_at") or "")
+        if current_updated and new_updated and current_updated != new_updated:
+            return new_updated > current_updated
+        if current.get("state") == new.get("state"):
+            return False
+        return None
+
+    def handle_callback_payload(self, payment: OrderPayment, data: dict):
+        """Applies a verified callback payload.
+
+        Returns whether the stored payment changed. Once the payload has
+        been processed, repeated notifications with the same operations
+        are ignored.
+        """
+        with timed("callback_processing", **self._metric_labels()) as metric:
+            with payment_lock(payment):
+                payment.refresh_from_db(fields=["info", "state"])
+                newer = None
+                if self.trust_callback_payload:
+                    newer = self._is_newer_payment_info(payment.info_data, data)
+                if newer is None:
+                    # get the current info from provider, as we can run into race
+                    # conditions
+                    metric["outcome"] = "fetched"
+                    changed = self._fetch_current_payment(payment)
+                elif newer:
+                    changed = self._update_payment_info(payment, data)
+                    metric["outcome"] = "applied" if changed else "unchanged"
+                else:
+                    metric["outcome"] = "outdated"
+                    changed = False
+            cache.set(
+                _callback_cache_key(payment, data), True, CALLBACK_DEDUPLICATION_TIMEOUT
+            )
+            return changed
 
     def get_current_payment(self, payment):
-        current_payment_info = payment.info_data
-        payment_id = current_payment_info.get("id")
         try:
-            client = self._init_client()
-            # get the current info from provider, as we can run into race conditions here
-            new_payment_info = client.get("/payments/%s" % payment_id)
-        except Exception as e:
-            logger.exception("Quickpay Payments error: %s" % e)
+            with payment_lock(payment):
+                payment.refresh_from_db(fields=["info", "state"])
+                # The return view and callbacks often ask for the same payment at
+                # nearly the same time, one fetch within a short period is enough.
+                # If the previous holder of the lock fetched the payment, we share
+                # its result. Holders that only applied a payload did not fetch,
+                # so we still ask the provider after them.
+                if not cache.add(
+                    f"pretix_quickpay:refresh:{payment.pk}",
+                    True,
+                    REFRESH_DEDUPLICATION_TIMEOUT,
+                ):
+                    return
+                try:
+                    self._fetch_current_payment(payment)
+                except Exception as e:
+                    logger.exception("Quickpay Payments error: %s" % e)
+        except PaymentLockTimeout as e:
+            # Somebody else is still busy with this payment
+            logger.warning(str(e))
+
+    def _fetch_current_payment(self, payment):
+        payment_id = payment.info_data.get("id")
+        client = self._init_client()
+        new_payment_info = client.get("/payments/%s" % payment_id)
+        return self._update_payment_info(payment, new_payment_info)
+
+    def apply_payment_info(self, payment, new_payment_info, only_newer=False):
+        """Stores a payment object that was just fetched from the provider,
+        e.g. during reconciliation, and handles the resulting state change.
+
+        With ``only_newer``, payment objects that are known to be older
+        than the stored one are ignored. Returns whether the stored
+        payment changed.
+        """
+        with payment_lock(payment):
+            payment.refresh_from_db(fields=["info", "state"])
+            if (
+                only_newer
+                and self._is_newer_payment_info(payment.info_data, new_payment_info)
+                is False
+                and compact_payment_info(new_payment_info)
+                != compact_payment_info(payment.info_data)
+            ):
+                return False
+            return self._update_payment_info(payment, new_payment_info)
+
+    def _update_payment_info(self, payment, new_payment_info):
+        """Stores the payment object and handles its state change.
+
+        Returns whether the stored payment changed; if it did not, the
+        row is not written at all.
+        """
+        current_payment_info = payment.info_data
+        new_compact_info = compact_payment_info(new_payment_info)
+        changed = new_compact_info != compact_payment_info(current_payment_info)
+        if changed:
+            # Save newest payment object to info
+            payment.info_data = new_compact_info
+            payment.save(update_fields=["info"])
+            prev_payment_state = current_payment_info.get("state", "")
+            new_payment_state = new_payment_info.get("state", "")
+            if new_payment_state != prev_payment_state:
+                self._handle_state_change(payment, new_payment_info)
+        if any(
+            op.get("type") == "refund" for op in new_payment_info.get("operations", [])
+        ):
+            # Even if we have seen these operations before, a refund might only have
+            # been put in transit after we did.
+            self._handle_refund_operations(payment, new_payment_info["operations"])
+        return changed
+
+    def _handle_refund_operations(self, payment: OrderPayment, operations):
+        """Completes or fails the refunds in transit for this payment according
+        to the finished refund operations reported by the provider."""
+        refunds = list(payment.refunds.filter(state=OrderRefund.REFUND_STATE_TRANSIT))
+        if not refunds:
             return
-        # Save newest payment object to info
-        payment.info_data = new_payment_info
-        payment.save(update_fields=["info"])
-        prev_payment_state = current_payment_info.get("state", "")
-        new_payment_state = new_payment_info.get("state", "")
-        if new_payment_state != prev_payment_state:
-            self._handle_state_change(payment)
+        refund_operations = {
+            op.get("id"): op for op in operations if op.get("type") == "refund"
+        }
+        # Operations of finished refunds are claimed as well, so that a refund in
+        # transit is not matched to an earlier refund of the same amount
+        claimed = {
+            r.info_data.get("refund_operation_id") for r in payment.refunds.all()
+        }
+        for refund in refunds:
+            operation = refund_operations.get(
+                refund.info_data.get("refund_operation_id")
+            )
+            if not operation:
+                # Fall back to the first unclaimed operation with the same amount
+                amount = self._decimal_to_int(refund.amount)
+                for op_id, op in refund_operations.items():
+                    if op_id not in claimed and op.get("amount") == amount:
+                        operation = op
+                        claimed.add(op_id)
+                        refund.info_data = dict(
+                            refund.info_data, refund_operation_id=op_id
+                        )
+                        refund.save(update_fields=["info"])
+                        break
+            if not operation or operation.get("pending"):
+                continue
+            if operation.get("qp_status_code") == "20000":
+                refund.done()
+            else:
+                refund.state = OrderRefund.REFUND_STATE_FAILED
+                refund.execution_date = now()
+                refund.save(update_fields=["state", "execution_date"])
@@ -1,8 +1,12 @@
-from django import forms
+from django.utils.text import format_lazy
 from django.utils.translation import gettext_lazy as _
 
 from .payment import QuickpayMethod, QuickpaySettingsHolder
+from .registry import register_payment_method
 
+# Besides the slug, type and names, a method can declare constraints on the orders it
+# can be used for: "currencies" (a set of currency codes) as well as "min_amount"
+# and "max_amount" (Decimals in the event's currency).
 payment_methods = [
     # This is disabled to give merchants the ability to choose from all card options below instead of all at once
     # {
@@ -24,6 +28,7 @@ payment_methods = [
         "type": "scheme",
         "public_name": _("Dankort Credit"),
         "verbose_name": _("Dankort Credit"),
+        "currencies": frozenset({"DKK"}),
     },
     {
         "method": "diners",
@@ -72,6 +77,7 @@ payment_methods = [
         "type": "other",
         "public_name": _("Forbrugsforeningen af 1886"),
         "verbose_name": _("Forbrugsforeningen af 1886"),
+        "currencies": frozenset({"DKK"}),
     },
     {
         "method": "apple-pay",
@@ -90,18 +96,21 @@ payment_methods = [
         "type": "other",
         "public_name": _("ANYDAY Split"),
         "verbose_name": _("ANYDAY Split"),
+        "currencies": frozenset({"DKK"}),
     },
     {
         "method": "mobilepay",
         "type": "other",
         "public_name": _("MobilePay online"),
         "verbose_name": _("MobilePay online"),
+        "currencies": frozenset({"DKK", "EUR"}),
     },
     {
         "method": "mobilepay-subscriptions",
         "type": "other",
         "public_name": _("MobilePay Subscriptions"),
         "verbose_name": _("MobilePay Subscriptions"),
+        "currencies": frozenset({"DKK", "EUR"}),
     },
     {
         "method": "paypal",
@@ -114,6 +123,7 @@ payment_methods = [
         "type": "other",
         "public_name": _("Sofort"),
         "verbose_name": _("Sofort"),
+        "currencies": frozenset({"EUR", "CHF", "GBP", "PLN"}),
     },
     {
         "method": "viabill",
@@ -144,6 +154,7 @@ payment_methods = [
         "type": "other",
         "public_name": _("Swish"),
         "verbose_name": _("Swish"),
+        "currencies": frozenset({"SEK"}),
     },
     {
         "method": "trustly",
@@ -156,12 +167,14 @@ payment_methods = [
         "type": "other",
         "public_name": _("iDEAL | Wero"),
         "verbose_name": _("iDEAL"),
+        "currencies": frozenset({"EUR"}),
     },
     {
         "method": "vipps",
         "type": "other",
         "public_name": _("Vipps"),
         "verbose_name": _("Vipps"),
+        "currencies": frozenset({"NOK"}),
     },
     {
         "method": "paysafecard",
@@ -174,51 +187,43 @@ payment_methods = [
         "type": "other",
         "public_name": _("Unzer Pay Later Invoice"),
         "verbose_name": _("Unzer Pay Later Invoice"),
+        "currencies": frozenset({"EUR", "CHF"}),
     },
 ]
 
 
+# method slug -> payment method descriptor
+payment_methods_by_slug = {m["method"]: m for m in payment_methods}
+
+
 def get_payment_method_classes(brand, payment_methods, baseclass, settingsholder):
-    settingsholder.payment_methods_settingsholder = []
-    for m in payment_methods:
-        settingsholder.payment_methods_settingsholder.append(
-            (
-                "method_{}".format(m["method"]),
-                forms.BooleanField(
-                    label="{} {}".format(
-                        (
-                            '<span class="fa fa-credit-card"></span>'
-                            if m["type"] in ["scheme", "meta"]
-                            else ""
-                        ),
-                        m["verbose_name"],
-                    ),
-                    help_text=_(
-                        "Needs to be enabled in your payment provider's account first. {m_help_text}"
-                    ).format(m_help_text=m.get("help_text", "")),
-                    required=False,
-                ),
-            )
-        )
+    settingsholder.payment_method_descriptors = payment_methods
 
-    return [settingsholder] + [
-        type(
+    classes = [settingsholder]
+    for m in payment_methods:
+        provider_class = type(
             f'Quickpay{"".join(m["public_name"].split())}',
             (m["baseclass"] if "baseclass" in m else baseclass,),
             {
                 "identifier": "{payment_provider}_{payment_method}".format(
                     payment_method=m["method"], payment_provider=brand.lower()
                 ),
-                "verbose_name": _("{payment_method} via {payment_provider}").format(
-                    payment_method=m["verbose_name"], payment_provider=brand
+                "verbose_name": format_lazy(
+                    _("{payment_method} via {payment_provider}"),
+                    payment_method=m["verbose_name"],
+                    payment_provider=brand,
                 ),
                 "public_name": m["public_name"],
                 "method": m["method"],
                 "type": m["type"],
+                "currencies": m.get("currencies"),
+                "min_amount": m.get("min_amount"),
+                "max_amount": m.get("max_amount"),
             },
         )
-        for m in payment_methods
-    ]
+        register_payment_method(brand.lower(), m, provider_class)
+        classes.append(provider_class)
+    return classes
 
 
 payment_method_classes = get_payment_method_classes(
@@ -0,0 +1,438 @@
+import asyncio
+import logging
+import re
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+from django.utils.timezone import now
+from itertools import islice
+from pretix.base.models import OrderPayment, OrderRefund
+from pretix.base.settings import SettingsSandbox
+
+from .client import AsyncProviderClient, _is_unsent, get_client
+from .payment import PaymentLockTimeout, compact_payment_info
+from .registry import methods_by_identifier
+
+logger = logging.getLogger("pretix_quickpay")
+
+# ``OrderPayment.full_id``, which is the order_id of payments at the provider
+FULL_ID_RE = re.compile(r"^(?P<code>[A-Z0-9]+)-P-(?P<local_id>[0-9]+)$")
+
+
+class RateLimiter:
+    """Spaces out calls across threads so that at most ``rate`` calls per
+    second start."""
+
+    def __init__(self, rate):
+        self.interval = 1 / rate if rate else 0
+        self.next_call = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self):
+        """Reserves the next slot and returns the number of seconds to wait for
+        it."""
+        with self.lock:
+            now = time.monotonic()
+            delay = self.next_call - now
+            self.next_call = max(now, self.next_call) + self.interval
+        return max(delay, 0)
+
+    def wait(self):
+        time.sleep(self.reserve())
+
+
+def pending_payments():
+    """Payments that are still open, or that have refunds whose outcome is
+    unknown."""
+    return (
+        OrderPayment.objects.filter(
+            Q(
+                state__in=(
+                    OrderPayment.PAYMENT_STATE_CREATED,
+                    OrderPayment.PAYMENT_STATE_PENDING,
+                )
+            )
+            | Q(refunds__state=OrderRefund.REFUND_STATE_TRANSIT),
+            provider__in=list(methods_by_identifier),
+        )
+        .select_related("order", "order__event")
+        .distinct()
+        .order_by("pk")
+    )
+
+
+class ThreadedFetcher:
+    """Fetches payments from the provider in a pool of worker threads."""
+
+    def __init__(self, workers, rate_limiter):
+        self.rate_limiter = rate_limiter
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.executor.shutdown()
+
+    def _fetch(self, client, payment_id):
+        self.rate_limiter.wait()
+        return client.get("/payments/%s" % payment_id)
+
+    def fetch(self, jobs):
+        """Yields every ``(provider, payment)`` job together with the fetched
+        payment object, or the exception raised while fetching it."""
+        futures = {
+            self.executor.submit(
+                self._fetch, pprov._init_client(), payment.info_data["id"]
+            ): (pprov, payment)
+            for pprov, payment in jobs
+        }
+        for future in as_completed(futures):
+            try:
+                yield futures[future], future.result()
+            except Exception as e:
+                yield futures[future], e
+
+
+class AsyncFetcher:
+    """Fetches payments from the provider concurrently on an asyncio event loop
+    in the calling thread, without a thread per request.
+
+    Clients and their connections are reused across batches.
+    """
+
+    def __init__(self, concurrency, rate_limiter):
+        self.concurrency = concurrency
+        self.rate_limiter = rate_limiter
+        self.loop = asyncio.new_event_loop()
+        self.clients = {}
+        self.semaphore = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        for client in self.clients.values():
+            self.loop.run_until_complete(client.__aexit__(*args))
+        self.loop.close()
+
+    async def _fetch(self, client, payment_id):
+        async with self.semaphore:
+            await asyncio.sleep(self.rate_limiter.reserve())
+            try:
+                return await client.get("/payments/%s" % payment_id)
+            except Exception as e:
+                return e
+
+    async def _fetch_all(self, requests):
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.concurrency)
+        tasks = []
+        for apikey, labels, payment_id in requests:
+            if apikey not in self.clients:
+                self.clients[apikey] = await AsyncProviderClient(
+                    apikey, limit=self.concurrency
+                ).__aenter__()
+            client = self.clients[apikey].labelled(**labels)
+            tasks.append(self._fetch(client, payment_id))
+        return await asyncio.gather(*tasks)
+
+    def fetch(self, jobs):
+        # Settings may be read from the database, which must not happen on the loop
+        requests = [
+            (
+                pprov.settings.get("apikey"),
+                pprov._metric_labels(),
+                payment.info_data["id"],
+            )
+            for pprov, payment in jobs
+        ]
+        return zip(jobs, self.loop.run_until_complete(self._fetch_all(requests)))
+
+
+def reconcile_payments(payments, workers=8, rate=10, progress=None, use_asyncio=False):
+    """Fetches the current state of the given payments from the provider with a
+    bounded number of concurrent requests and applies it. Provider requests run
+    in worker threads, or on an asyncio event loop if ``use_asyncio`` is set.
+    All database work happens in the calling thread.
+
+    ``progress`` is called with the statistics after every batch of
+    payments.
+    """
+    rate_limiter = RateLimiter(rate)
+    providers = {}
+    stats = {"total": 0, "changed": 0, "failed": 0, "skipped": 0}
+    payments = iter(payments)
+    fetcher_class = AsyncFetcher if use_asyncio else ThreadedFetcher
+    with fetcher_class(workers, rate_limiter) as fetcher:
+        while True:
+            batch = list(islice(payments, workers * 4))
+            if not batch:
+                break
+            jobs = []
+            for payment in batch:
+                stats["total"] += 1
+                key = (payment.order.event_id, payment.provider)
+                if key not in providers:
+                    providers[key] = payment.order.event.get_payment_providers(
+                        cached=True
+                    ).get(payment.provider)
+                pprov = providers[key]
+                if not pprov or not payment.info_data.get("id"):
+                    stats["skipped"] += 1
+                    continue
+                jobs.append((pprov, payment))
+
+            for (pprov, payment), result in fetcher.fetch(jobs):
+                if isinstance(result, Exception):
+                    logger.warning(
+                        "Could not fetch payment %s from provider: %s",
+                        payment.full_id,
+                        result,
+                    )
+                    stats["failed"] += 1
+                    continue
+                prev_state = payment.state
+                try:
+                    pprov.apply_payment_info(payment, result)
+                except PaymentLockTimeout as e:
+                    logger.warning(str(e))
+                    stats["failed"] += 1
+                    continue
+                if payment.state != prev_state:
+                    stats["changed"] += 1
+
+            if progress:
+                progress(stats)
+    return stats
+
+
+def _list_payment_pages(client, since, page_size):
+    """Yields the payments of the merchant account created after ``since``,
+    newest first, one page at a time."""
+    page = 1
+    while True:
+        results = client.get(
+            "/payments",
+            query={
+                "page": page,
+                "page_size": page_size,
+                "sort_by": "id",
+                "sort_dir": "desc",
+            },
+        )
+        items = []
+        for item in results or []:
+            created_at = parse_datetime(item.get("created_at") or "")
+            if created_at and created_at < since:
+                break
+            items.append(item)
+        if items:
+            yield items
+        if len(items) < page_size:
+            return
+        page += 1
+
+
+def _payments_for_page(events, brand, items):
+    """Returns the ``OrderPayment`` objects of the events that may belong to
+    the listed payments, keyed by the ``order_id`` a payment was created with
+    at the provider."""
+    q = Q()
+    for item in items:
+        m = FULL_ID_RE.match(str(item.get("order_id") or ""))
+        if m:
+            q |= Q(order__code=m.group("code"), local_id=int(m.group("local_id")))
+    if not q:
+        return {}
+    payments = defaultdict(list)
+    for p in OrderPayment.objects.filter(
+        q, order__event__in=events, provider__startswith=f"{brand}_"
+    ).select_related("order"):
+        payments[p.full_id].append(p)
+    return payments
+
+
+def sync_payments_by_listing(events, brand, since, page_size=100):
+    """Pages through the provider's payment list of a merchant account once and
+    merges every payment created after ``since`` into the matching
+    ``OrderPayment`` of the given events, which all use that account, looking
+    up the payments of one page at a time. Payments are matched by the
+    ``order_id`` they were created with, so this also finds payments whose
+    creation response got lost. Payments prepared before their order existed
+    carry a different reference and are only covered by the regular
+    reconciliation.
+
+    Changes are applied like a callback, i.e. under the payment's lock
+    and only if the listed payment is newer than the stored one.
+    """
+    stats = {"total": 0, "matched": 0, "changed": 0}
+    events = {event.pk: event for event in events}
+    providers = {}
+    client = get_client(
+        SettingsSandbox("payment", brand, next(iter(events.values()))).get("apikey")
+    ).labelled(brand)
+    for items in _list_payment_pages(client, since, page_size):
+        stats["total"] += len(items)
+        payments = _payments_for_page(list(events), brand, items)
+        for item in items:
+            candidates = [
+                p
+                for p in payments.get(item.get("order_id"), [])
+                if p.info_data.get("id") in (None, item.get("id"))
+            ]
+            if len(candidates) != 1:
+                continue
+            payment = candidates[0]
+            if payment.order.event_id not in providers:
+                providers[payment.order.event_id] = events[
+                    payment.order.event_id
+                ].get_payment_providers(cached=True)
+            pprov = providers[payment.order.event_id].get(payment.provider)
+            if not pprov:
+                continue
+            stats["matched"] += 1
+            if payment.info_data == compact_payment_info(item) and not any(
+                op.get("type") == "refund" for op in item.get("operations", [])
+            ):
+                continue
+            try:
+                if pprov.apply_payment_info(payment, item, only_newer=True):
+                    stats["changed"] += 1
+            except PaymentLockTimeout as e:
+                # The payment is being updated right now anyway
+                logger.warning(str(e))
+    return stats
+
+
+def pending_refunds():
+    return (
+        OrderRefund.objects.filter(
+            provider__in=list(methods_by_identifier),
+            state=OrderRefund.REFUND_STATE_CREATED,
+        )
+        .select_related("order", "order__event", "payment")
+        .order_by("pk")
+    )
+
+
+def execute_refunds(refunds, workers=8, rate=10, progress=None):
+    """Submits the given refunds to the provider with a bounded number of
+    concurrent requests, limited to ``rate`` requests per second for every
+    merchant account, and stores the results with the same status handling as
+    ``execute_refund``. Every refund is claimed before it is submitted, so it
+    is submitted only once. Refunds whose request provably did not reach the
+    provider are put back to be submitted again later, other refunds that could
+    not be submitted are marked as failed. Refund states are written in bulk
+    per batch. Accepted refunds stay in transit until the provider reports
+    their outcome.
+
+    ``progress`` is called with the statistics after every batch of
+    refunds.
+    """
+    rate_limiters = defaultdict(lambda: RateLimiter(rate))
+    providers = {}
+    stats = {
+        "total": 0,
+        "accepted": 0,
+        "failed": 0,
+        "errors": 0,
+        "unsent": 0,
+        "skipped": 0,
+    }
+    refunds = iter(refunds)
+
+    def submit(pprov, client, rate_limiter, refund):
+        rate_limiter.wait()
+        return pprov._request_refund(client, refund)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while True:
+            batch = list(islice(refunds, workers * 4))
+            if not batch:
+                break
+            futures = {}
+            for refund in batch:
+                stats["total"] += 1
+                key = (refund.order.event_id, refund.provider)
+                if key not in providers:
+                    providers[key] = refund.order.event.get_payment_providers(
+                        cached=True
+                    ).get(refund.provider)
+                pprov = providers[key]
+                if (
+                    not pprov
+                    or not refund.payment
+                    or not refund.payment.info_data.get("id")
+                    or not pprov._claim_refund(refund)
+                ):
+                    stats["skipped"] += 1
+                    continue
+                future = executor.submit(
+                    submit,
+                    pprov,
+                    pprov._init_client(),
+                    rate_limiters[pprov.settings.get("apikey")],
+                    refund,
+                )
+                futures[future] = (pprov, refund)
+
+            updated = []
+            for future in as_completed(futures):
+                pprov, refund = futures[future]
+                try:
+                    status, body = future.result()
+                except Exception as e:
+                    logger.warning(
+                        "Could not submit refund %s to provider: %s", refund.full_id, e
+                    )
+                    if _is_unsent(e):
+                        pprov._release_refund(refund)
+                        stats["unsent"] += 1
+                        continue
+                    stats["errors"] += 1
+                    # We cannot tell whether the provider got the request, so the
+                    # refund must not be submitted again.
+                    refund.state = OrderRefund.REFUND_STATE_FAILED
+                    refund.execution_date = now()
+                    updated.append((pprov, refund))
+                    continue
+                pprov._apply_refund_response(refund, status, body)
+                updated.append((pprov, refund))
+                if status == 202:
+                    stats["accepted"] += 1
+                else:
+                    stats["failed"] += 1
+
+            OrderRefund.objects.bulk_update(
+                [refund for pprov, refund in updated],
+                ["state", "execution_date", "info"],
+            )
+            for pprov, refund in updated:
+                if refund.state == OrderRefund.REFUND_STATE_FAILED:
+                    refund.order.log_action(
+                        "pretix.event.order.refund.failed",
+                        data={
+                            "local_id": refund.local_id,
+                            "provider": refund.provider,
+                        },
+                    )
+                    continue
+                refund.order.log_action(
+                    f"pretix_{pprov.identifier.split('_')[0]}.event",
+                    data=refund.info_data,
+                )
+                operations = refund.info_data.get("operations", [])
+                if refund.state == OrderRefund.REFUND_STATE_TRANSIT and any(
+                    op.get("type") == "refund" and not op.get("pending")
+                    for op in operations
+                ):
+                    # In case the provider already finished the refund operation
+                    pprov._handle_refund_operations(refund.payment, operations)
+
+            if progress:
+                progress(stats)
+    return stats
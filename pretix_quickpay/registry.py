@@ -0,0 +1,26 @@
+# Registry of the payment methods offered by each brand (the first part of a provider
+# identifier, e.g. "quickpay" or "unzerdirect"), filled once at import time of the
+# paymentmethods modules.
+
+# brand -> method slug -> registered payment method
+methods_by_brand = {}
+# provider identifier -> registered payment method
+methods_by_identifier = {}
+# brand -> slugs of all methods that are card schemes
+card_methods_by_brand = {}
+
+
+def register_payment_method(brand, descriptor, provider_class):
+    entry = dict(
+        descriptor,
+        brand=brand,
+        identifier=provider_class.identifier,
+        provider_class=provider_class,
+    )
+    methods_by_brand.setdefault(brand, {})[descriptor["method"]] = entry
+    methods_by_identifier[provider_class.identifier] = entry
+    if descriptor["type"] in ("meta", "scheme"):
+        card_methods_by_brand[brand] = card_methods_by_brand.get(brand, frozenset()) | {
+            descriptor["method"]
+        }
+    return entry
@@ -0,0 +1,28 @@
+document.addEventListener("DOMContentLoaded", function () {
+    var el = document.getElementById("quickpay-status");
+    if (!el) {
+        return;
+    }
+    var url = el.getAttribute("data-url");
+    var state = el.getAttribute("data-state");
+    var attempts = 0;
+
+    function poll() {
+        attempts++;
+        fetch(url, {credentials: "same-origin"}).then(function (response) {
+            return response.json();
+        }).then(function (data) {
+            if (data.state !== state) {
+                window.location.reload();
+            } else if (attempts < 40) {
+                window.setTimeout(poll, 3000);
+            }
+        }).catch(function () {
+            if (attempts < 40) {
+                window.setTimeout(poll, 3000);
+            }
+        });
+    }
+
+    window.setTimeout(poll, 3000);
+});
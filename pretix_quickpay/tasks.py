@@ -0,0 +1,59 @@
+import logging
+from pretix.base.models import Event, OrderPayment
+from pretix.base.services.tasks import EventTask
+from pretix.celery_app import app
+
+from .client import CircuitOpenError, _is_transient
+
+logger = logging.getLogger("pretix_quickpay")
+
+
+@app.task(base=EventTask, bind=True, max_retries=5)
+def process_callback(self, event: Event, payment: int, data: dict):
+    try:
+        payment = OrderPayment.objects.select_related("order").get(
+            order__event=event, pk=payment
+        )
+    except OrderPayment.DoesNotExist:
+        logger.warning("Quickpay Callback for unknown payment %s", payment)
+        return
+
+    pprov = payment.payment_provider
+    try:
+        changed = pprov.handle_callback_payload(payment, data)
+    except Exception as e:
+        from .payment import PaymentLockTimeout
+
+        retryable = (CircuitOpenError, PaymentLockTimeout)
+        if not isinstance(e, retryable) and not _is_transient(e):
+            raise
+        # The callback has already been acknowledged, so the provider won't send
+        # it again and we have to try again ourselves.
+        logger.warning("Quickpay Callback for payment %s failed: %s", payment.pk, e)
+        raise self.retry(exc=e, countdown=10 * 2**self.request.retries)
+    if changed:
+        payment.order.log_action(
+            f"pretix_{pprov.identifier.split('_')[0]}.event",
+            data=data,
+        )
+
+
+@app.task(base=EventTask, bind=True)
+def refresh_payment(self, event: Event, payment: int):
+    try:
+        payment = OrderPayment.objects.select_related("order").get(
+            order__event=event, pk=payment
+        )
+    except OrderPayment.DoesNotExist:
+        return
+
+    payment.payment_provider.get_current_payment(payment)
+
+
+@app.task(base=EventTask, bind=True)
+def precreate_payment(self, event: Event, provider: str, token: str):
+    pprov = event.get_payment_providers().get(provider)
+    if pprov is None:
+        return
+
+    pprov.precreate_payment(token)
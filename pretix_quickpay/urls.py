@@ -1,7 +1,7 @@
 from django.urls import include, re_path
 from pretix.multidomain import event_url
 
-from .views import CallbackView, ReturnView
+from .views import CallbackView, ReturnView, StatusView
 
 
 def get_event_patterns(brand):
@@ -22,6 +22,12 @@ def get_event_patterns(brand):
                         name="callback",
                         require_live=False,
                     ),
+                    event_url(
+                        r"^status/(?P<order>[^/]+)/(?P<hash>[^/]+)/(?P<payment>[^/]+)/$",
+                        StatusView.as_view(),
+                        name="status",
+                        require_live=False,
+                    ),
                 ]
             ),
         ),
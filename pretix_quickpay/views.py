@@ -1,46 +1,52 @@
 import hashlib
-from django.http import Http404, HttpResponse
-from django.shortcuts import get_object_or_404, redirect
+import hmac
+from django.core.cache import cache
+from django.http import Http404, HttpResponse, JsonResponse
+from django.shortcuts import redirect
 from django.utils.decorators import method_decorator
 from django.utils.functional import cached_property
 from django.views import View
 from django.views.decorators.csrf import csrf_exempt
-from pretix.base.models import Order
+from pretix.base.models import Order, OrderPayment
 from pretix.multidomain.urlreverse import eventreverse
 
+from .tasks import refresh_payment
+
+# Seconds between refreshes from the provider triggered by status polling
+STATUS_REFRESH_INTERVAL = 15
+
 
 class QuickpayOrderView:
     def dispatch(self, request, *args, **kwargs):
         try:
-            self.order = request.event.orders.get(code=kwargs["order"])
-            if (
-                hashlib.sha1(self.order.secret.lower().encode()).hexdigest()
-                != kwargs["hash"].lower()
-            ):
-                raise Http404("Unknown order")
-        except Order.DoesNotExist:
+            self.payment = OrderPayment.objects.select_related("order").get(
+                order__event=request.event,
+                order__code=kwargs["order"],
+                pk=kwargs["payment"],
+                # Identifiers of all methods of a brand share its prefix, this also
+                # matches methods that are not offered anymore.
+                provider__startswith="{}_".format(kwargs["payment_provider"]),
+            )
+            self.order = self.payment.order
+            secret = self.order.secret
+        except (OrderPayment.DoesNotExist, ValueError):
             # Do a hash comparison as well to harden timing attacks
-            if (
-                "abcdefghijklmnopq".lower()
-                == hashlib.sha1("abcdefghijklmnopq".encode()).hexdigest()
-            ):
-                raise Http404("Unknown order")
-            else:
-                raise Http404("Unknown order")
+            secret = "abcdefghijklmnopq"
+            self.payment = None
+        if (
+            not hmac.compare_digest(
+                hashlib.sha1(secret.lower().encode()).hexdigest().encode(),
+                kwargs["hash"].lower().encode(),
+            )
+            or self.payment is None
+        ):
+            raise Http404("Unknown order")
         return super().dispatch(request, *args, **kwargs)
 
     @cached_property
     def pprov(self):
         return self.payment.payment_provider
 
-    @property
-    def payment(self):
-        return get_object_or_404(
-            self.order.payments,
-            pk=self.kwargs["payment"],
-            provider__istartswith=self.kwargs["payment_provider"],
-        )
-
     def _redirect_to_order(self):
         return redirect(
             eventreverse(
@@ -51,18 +57,47 @@ class QuickpayOrderView:
             + ("?paid=yes" if self.order.status == Order.STATUS_PAID else "")
         )
 
+    def _refresh_payment(self):
+        refresh_payment.apply_async(
+            kwargs={"event": self.request.event.pk, "payment": self.payment.pk}
+        )
+
 
 @method_decorator(csrf_exempt, name="dispatch")
 class ReturnView(QuickpayOrderView, View):
     def post(self, request, *args, **kwargs):
-        self.pprov.get_current_payment(self.payment)
+        # The callback usually arrives at the same time, the order page polls the
+        # status view until the payment has been updated.
+        self._refresh_payment()
         return self._redirect_to_order()
 
     def get(self, request, *args, **kwargs):
-        self.pprov.get_current_payment(self.payment)
+        self._refresh_payment()
         return self._redirect_to_order()
 
 
+class StatusView(QuickpayOrderView, View):
+    def get(self, request, *args, **kwargs):
+        payment = self.payment
+        if payment.state in (
+            OrderPayment.PAYMENT_STATE_CREATED,
+            OrderPayment.PAYMENT_STATE_PENDING,
+        ) and cache.add(
+            f"pretix_quickpay:status_refresh:{payment.pk}",
+            True,
+            STATUS_REFRESH_INTERVAL,
+        ):
+            # In case the callback got lost, we ask the provider every now and then
+            self._refresh_payment()
+        return JsonResponse(
+            {
+                "state": payment.state,
+                "provider_state": payment.info_data.get("state"),
+                "paid": self.order.status == Order.STATUS_PAID,
+            }
+        )
+
+
 @method_decorator(csrf_exempt, name="dispatch")
 class CallbackView(QuickpayOrderView, View):
     def post(self, request, *args, **kwargs):
@@ -14,7 +14,7 @@ class UnzerdirectSettingsHolder(QuickpaySettingsHolder):
     verbose_name = _("Unzer Direct")
     is_enabled = False
     is_meta = True
-    payment_methods_settingsholder = []
+    payment_method_descriptors = []
 
 
 class UnzerdirectMethod(SuperQuickpayMethod):
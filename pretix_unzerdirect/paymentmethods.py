@@ -1,6 +1,6 @@
 from pretix_quickpay.paymentmethods import (
     get_payment_method_classes,
-    payment_methods as payment_methods_repo,
+    payment_methods_by_slug,
 )
 
 from .payment import UnzerdirectMethod, UnzerdirectSettingsHolder
@@ -11,14 +11,12 @@ supported_methods = [
     "visa",
     "apple-pay",
     "google-pay",
-    "klarna-payments",
     "paypal",
     "sofort",
+    "klarna-payments",
     "unzer-pay-later-invoice",
 ]
-payment_methods = [
-    item for item in payment_methods_repo if item.get("method") in supported_methods
-]
+payment_methods = [payment_methods_by_slug[method] for method in supported_methods]
 
 payment_method_classes = get_payment_method_classes(
     "Unzerdirect", payment_methods, UnzerdirectMethod, UnzerdirectSettingsHolder
@@ -1 +1,164 @@
-# put your pytest fixtures here
+import pytest
+import statistics
+import time
+from datetime import timedelta
+from decimal import Decimal
+from django.core.cache import cache
+from django.utils.timezone import now
+from django_scopes import scopes_disabled
+from pretix.base.models import Event, Order, OrderPayment, Organizer
+
+from pretix_quickpay import client
+
+from .quickpay_server import QuickpayStubServer
+
+benchmark_results = []
+
+
+def pytest_addoption(parser):
+    parser.addoption(
+        "--benchmarks", action="store_true", help="Run the Quickpay benchmarks"
+    )
+
+
+def pytest_configure(config):
+    config.addinivalue_line(
+        "markers", "benchmark: benchmark, only run with --benchmarks"
+    )
+
+
+def pytest_collection_modifyitems(config, items):
+    if config.getoption("--benchmarks"):
+        return
+    skip = pytest.mark.skip(reason="Benchmarks only run with --benchmarks")
+    for item in items:
+        if "benchmark" in item.keywords:
+            item.add_marker(skip)
+
+
+@pytest.fixture(autouse=True)
+def locmem_cache(settings):
+    # Deduplication, locks and prepared payments need a cache that keeps values
+    settings.CACHES = {
+        "default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}
+    }
+    # Keys from earlier tests would suppress refreshes of payments with the same pk
+    cache.clear()
+    yield
+    cache.clear()
+
+
+@pytest.fixture
+def quickpay_server(monkeypatch, settings):
+    # The stub server listens on localhost
+    settings.ALLOW_HTTP_TO_PRIVATE_NETWORKS = True
+    server = QuickpayStubServer().start()
+    monkeypatch.setattr(client, "API_BASE_URL", server.url)
+    monkeypatch.setattr(client, "_clients", client.OrderedDict())
+    yield server
+    server.stop()
+
+
+@pytest.fixture
+@scopes_disabled()
+def event():
+    o = Organizer.objects.create(name="Dummy", slug="dummy")
+    event = Event.objects.create(
+        organizer=o,
+        name="Dummy",
+        slug="dummy",
+        date_from=now(),
+        currency="EUR",
+        plugins="pretix_quickpay",
+        live=True,
+    )
+    event.settings.set("payment_quickpay__enabled", True)
+    event.settings.set("payment_quickpay_method_visa", True)
+    event.settings.set("payment_quickpay_apikey", "apikey")
+    event.settings.set("payment_quickpay_privatekey", "privatekey")
+    return event
+
+
+@pytest.fixture
+def make_payment(event):
+    counter = iter(range(100000))
+
+    @scopes_disabled()
+    def make_payment(provider="quickpay_visa", amount=Decimal("23.00")):
+        order = Order.objects.create(
+            code="FOO{:05d}".format(next(counter)),
+            event=event,
+            sales_channel=event.organizer.sales_channels.get(identifier="web"),
+            email="dummy@dummy.test",
+            status=Order.STATUS_PENDING,
+            datetime=now(),
+            expires=now() + timedelta(days=10),
+            total=amount,
+        )
+        return order.payments.create(
+            provider=provider,
+            amount=amount,
+            state=OrderPayment.PAYMENT_STATE_CREATED,
+        )
+
+    return make_payment
+
+
+@pytest.fixture
+def provider(event):
+    return event.get_payment_providers()["quickpay_visa"]
+
+
+@pytest.fixture
+def provider_payment(quickpay_server, make_payment):
+    """Returns a payment that is known to the provider, together with the
+    provider's payment object after a successful capture."""
+
+    def provider_payment():
+        payment = make_payment()
+        payment.info_data = quickpay_server.create_payment(payment.full_id, "EUR")
+        payment.save(update_fields=["info"])
+        captured = quickpay_server.add_operation(
+            payment.info_data["id"], "capture", 2300
+        )
+        return payment, captured
+
+    return provider_payment
+
+
+@pytest.fixture
+def benchmark():
+    def benchmark(name, func, iterations, setup=None):
+        durations = []
+        for i in range(iterations):
+            args = setup(i) if setup else ()
+            start = time.perf_counter()
+            func(*args)
+            durations.append(time.perf_counter() - start)
+        benchmark_results.append((name, durations))
+        return durations
+
+    return benchmark
+
+
+def pytest_terminal_summary(terminalreporter):
+    if not benchmark_results:
+        return
+    terminalreporter.section("Quickpay benchmarks")
+    terminalreporter.write_line(
+        "{:<40} {:>6} {:>10} {:>10} {:>10} {:>10}".format(
+            "", "n", "ops/s", "p50 ms", "p90 ms", "p99 ms"
+        )
+    )
+    for name, durations in benchmark_results:
+        quantiles = statistics.quantiles(durations, n=100, method="inclusive")
+        terminalreporter.write_line(
+            "{:<40} {:>6} {:>10.1f} {:>10.2f} {:>10.2f} {:>10.2f}".format(
+                name,
+                len(durations),
+                len(durations) / sum(durations),
+                quantiles[49] * 1000,
+                quantiles[89] * 1000,
+                quantiles[98] * 1000,
+            )
+        )
@@ -0,0 +1,184 @@
+import json
+import random
+import re
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class QuickpayStubServer:
+    """A local HTTP server that mimics the parts of the Quickpay API used by
+    the plugin, with a configurable latency (in seconds) per request and rate
+    of 500 responses.
+
+    Errors are drawn from a seeded random generator, so runs are
+    reproducible, and setting ``failures`` makes exactly that many of
+    the next requests fail. ``max_in_flight`` is the highest number of
+    requests handled at the same time.
+    """
+
+    def __init__(self, latency=0.0, error_rate=0.0, seed=0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.failures = 0
+        self.failure_status = 500
+        self.random = random.Random(seed)
+        self.payments = {}
+        self.requests = Counter()
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.lock = threading.Lock()
+        self.next_id = 1000
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self.httpd.daemon_threads = True
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:%d" % self.httpd.server_address[1]
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def create_payment(self, order_id, currency):
+        with self.lock:
+            self.next_id += 1
+            ts = self._now()
+            payment = {
+                "id": self.next_id,
+                "order_id": order_id,
+                "currency": currency,
+                "state": "initial",
+                "accepted": False,
+                "test_mode": False,
+                "acquirer": None,
+                "balance": 0,
+                "link": None,
+                "operations": [],
+                "created_at": ts,
+                "updated_at": ts,
+            }
+            self.payments[payment["id"]] = payment
+        return payment
+
+    def add_operation(self, payment_id, type, amount, qp_status_code="20000"):
+        with self.lock:
+            payment = self.payments[payment_id]
+            payment["operations"].append(
+                {
+                    "id": len(payment["operations"]) + 1,
+                    "type": type,
+                    "amount": amount,
+                    "pending": False,
+                    "qp_status_code": qp_status_code,
+                    "qp_status_msg": "Approved",
+                    "created_at": self._now(),
+                }
+            )
+            if type == "capture":
+                payment["balance"] += amount
+                payment["state"] = "processed"
+                payment["accepted"] = True
+                payment["acquirer"] = "clearhaus"
+            elif type == "refund":
+                payment["balance"] -= amount
+            payment["updated_at"] = self._now()
+            return json.loads(json.dumps(payment))
+
+    def _now(self):
+        return datetime.now(timezone.utc).isoformat()
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def _respond(self, status, body):
+                data = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def _body(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                return json.loads(self.rfile.read(length) or b"{}")
+
+            def _handle(self, method):
+                path, _, query = self.path.partition("?")
+                body = self._body() if method in ("POST", "PUT") else {}
+                endpoint = re.sub(r"/\d+", "/{id}", path)
+                with server.lock:
+                    server.requests[f"{method} {endpoint}"] += 1
+                    server.in_flight += 1
+                    server.max_in_flight = max(server.max_in_flight, server.in_flight)
+                try:
+                    self._process(method, path, query, body)
+                finally:
+                    with server.lock:
+                        server.in_flight -= 1
+
+            def _process(self, method, path, query, body):
+                if server.latency:
+                    time.sleep(server.latency)
+                with server.lock:
+                    fail = server.failures > 0 or (
+                        server.error_rate and server.random.random() < server.error_rate
+                    )
+                    server.failures = max(server.failures - 1, 0)
+                if fail:
+                    return self._respond(server.failure_status, {"message": "Error"})
+
+                m = re.match(r"^/payments/(\d+)(/link|/refund)?$", path)
+                if method == "POST" and path == "/payments":
+                    return self._respond(
+                        201, server.create_payment(body["order_id"], body["currency"])
+                    )
+                if method == "GET" and path == "/payments":
+                    params = dict(p.split("=", 1) for p in query.split("&") if p)
+                    page_size = int(params.get("page_size", 20))
+                    start = (int(params.get("page", 1)) - 1) * page_size
+                    with server.lock:
+                        payments = sorted(
+                            server.payments.values(), key=lambda p: -p["id"]
+                        )
+                    return self._respond(200, payments[start:][:page_size])
+                if not m or int(m.group(1)) not in server.payments:
+                    return self._respond(404, {"message": "Not found"})
+                payment = server.payments[int(m.group(1))]
+                if method == "GET" and not m.group(2):
+                    with server.lock:
+                        return self._respond(200, payment)
+                if method == "PUT" and m.group(2) == "/link":
+                    with server.lock:
+                        payment["link"] = dict(
+                            body, url=f"{server.url}/pay/{payment['id']}"
+                        )
+                    return self._respond(200, {"url": payment["link"]["url"]})
+                if method == "POST" and m.group(2) == "/refund":
+                    return self._respond(
+                        202,
+                        server.add_operation(payment["id"], "refund", body["amount"]),
+                    )
+                return self._respond(404, {"message": "Not found"})
+
+            def do_GET(self):
+                self._handle("GET")
+
+            def do_POST(self):
+                self._handle("POST")
+
+            def do_PUT(self):
+                self._handle("PUT")
+
+        return Handler
@@ -0,0 +1,178 @@
+import hashlib
+import hmac
+import json
+import os
+import pytest
+from django.core.cache import cache
+from django_scopes import scope
+from pretix.base.models import OrderPayment, OrderRefund
+
+pytestmark = pytest.mark.benchmark
+
+ITERATIONS = int(os.environ.get("QUICKPAY_BENCHMARK_ITERATIONS", "50"))
+
+
+@pytest.mark.django_db
+def test_execute_payment(quickpay_server, event, provider, make_payment, benchmark, rf):
+    with scope(organizer=event.organizer):
+        payments = [make_payment() for _ in range(ITERATIONS)]
+        benchmark(
+            "execute_payment",
+            lambda p: provider.execute_payment(rf.get("/"), p),
+            ITERATIONS,
+            setup=lambda i: (payments[i],),
+        )
+    assert quickpay_server.requests["POST /payments"] == ITERATIONS
+    assert quickpay_server.requests["PUT /payments/{id}/link"] == ITERATIONS
+    assert quickpay_server.requests["GET /payments/{id}"] == 0
+    assert all(p.info_data["link"]["amount"] == 2300 for p in payments)
+
+
+@pytest.mark.django_db
+def test_execute_payment_precreated(
+    quickpay_server, event, provider, make_payment, benchmark, rf
+):
+    event.settings.set("payment_quickpay_precreate_payments", True)
+
+    def setup(i):
+        request = rf.get("/")
+        request.session = {}
+        # Renders the confirm page, which prepares the payment in the background
+        provider.checkout_confirm_render(request)
+        return request, make_payment()
+
+    with scope(organizer=event.organizer):
+        benchmark(
+            "execute_payment (precreated)",
+            provider.execute_payment,
+            ITERATIONS,
+            setup=setup,
+        )
+    assert quickpay_server.requests["POST /payments"] == ITERATIONS
+    assert quickpay_server.requests["PUT /payments/{id}/link"] == ITERATIONS
+
+
+@pytest.mark.django_db
+def test_handle_callback(
+    quickpay_server, event, provider, provider_payment, benchmark, rf
+):
+    def setup(i):
+        cache.clear()
+        payment, captured = provider_payment()
+        body = json.dumps(captured).encode()
+        request = rf.post(
+            "/",
+            data=body,
+            content_type="application/json",
+            HTTP_QUICKPAY_CHECKSUM_SHA256=hmac.new(
+                b"privatekey", body, hashlib.sha256
+            ).hexdigest(),
+        )
+        return request, payment
+
+    with scope(organizer=event.organizer):
+        benchmark("handle_callback", provider.handle_callback, ITERATIONS, setup=setup)
+        assert not OrderPayment.objects.filter(
+            provider="quickpay_visa", state=OrderPayment.PAYMENT_STATE_CREATED
+        ).exists()
+    # The verified callback payload is applied without asking the provider again
+    assert quickpay_server.requests["GET /payments/{id}"] == 0
+
+
+@pytest.mark.django_db
+def test_get_current_payment(
+    quickpay_server, event, provider, provider_payment, benchmark
+):
+    def setup(i):
+        cache.clear()
+        return (provider_payment()[0],)
+
+    with scope(organizer=event.organizer):
+        benchmark(
+            "get_current_payment",
+            provider.get_current_payment,
+            ITERATIONS,
+            setup=setup,
+        )
+        assert not OrderPayment.objects.filter(
+            provider="quickpay_visa", state=OrderPayment.PAYMENT_STATE_CREATED
+        ).exists()
+    assert quickpay_server.requests["GET /payments/{id}"] == ITERATIONS
+
+
+@pytest.mark.django_db
+def test_get_current_payment_with_errors(
+    quickpay_server, event, provider, provider_payment, benchmark
+):
+    quickpay_server.error_rate = 0.2
+
+    def setup(i):
+        cache.clear()
+        return (provider_payment()[0],)
+
+    with scope(organizer=event.organizer):
+        benchmark(
+            "get_current_payment (20% errors)",
+            provider.get_current_payment,
+            ITERATIONS,
+            setup=setup,
+        )
+        confirmed = OrderPayment.objects.filter(
+            provider="quickpay_visa", state=OrderPayment.PAYMENT_STATE_CONFIRMED
+        ).count()
+    # Failed requests are retried
+    assert confirmed >= ITERATIONS * 0.9
+
+
+@pytest.mark.django_db
+def test_execute_refund(quickpay_server, event, provider, provider_payment, benchmark):
+    def setup(i):
+        payment, captured = provider_payment()
+        payment.info_data = captured
+        payment.save(update_fields=["info"])
+        refund = payment.order.refunds.create(
+            payment=payment,
+            source=OrderRefund.REFUND_SOURCE_ADMIN,
+            state=OrderRefund.REFUND_STATE_CREATED,
+            amount=payment.amount,
+            provider=payment.provider,
+        )
+        return (refund,)
+
+    with scope(organizer=event.organizer):
+        benchmark("execute_refund", provider.execute_refund, ITERATIONS, setup=setup)
+    assert quickpay_server.requests["POST /payments/{id}/refund"] == ITERATIONS
+
+
+@pytest.mark.django_db
+def test_handle_callback_unchanged(
+    quickpay_server, event, provider, provider_payment, benchmark, rf
+):
+    payment, captured = provider_payment()
+    body = json.dumps(captured).encode()
+    checksum = hmac.new(b"privatekey", body, hashlib.sha256).hexdigest()
+
+    def setup(i):
+        cache.clear()
+        request = rf.post(
+            "/",
+            data=body,
+            content_type="application/json",
+            HTTP_QUICKPAY_CHECKSUM_SHA256=checksum,
+        )
+        return request, payment
+
+    with scope(organizer=event.organizer):
+        benchmark(
+            "handle_callback (unchanged)",
+            provider.handle_callback,
+            ITERATIONS,
+            setup=setup,
+        )
+        # Only the first delivery changed the payment and was logged
+        assert (
+            payment.order.all_logentries()
+            .filter(action_type="pretix_quickpay.event")
+            .count()
+            == 1
+        )
@@ -0,0 +1,144 @@
+import hashlib
+import hmac
+import json
+import pytest
+import threading
+import time
+from django.core.cache import cache
+from django_scopes import scope
+from pretix.base.models import OrderPayment
+
+from pretix_quickpay import payment as payment_module
+from pretix_quickpay.payment import _callback_cache_key
+
+
+def callback_request(rf, body, key=b"privatekey"):
+    return rf.post(
+        "/",
+        data=body,
+        content_type="application/json",
+        HTTP_QUICKPAY_CHECKSUM_SHA256=hmac.new(key, body, hashlib.sha256).hexdigest(),
+    )
+
+
+@pytest.mark.django_db
+def test_callback(quickpay_server, event, provider, provider_payment, rf):
+    payment, captured = provider_payment()
+    with scope(organizer=event.organizer):
+        provider.handle_callback(
+            callback_request(rf, json.dumps(captured).encode()), payment
+        )
+        payment.refresh_from_db()
+    assert payment.state == OrderPayment.PAYMENT_STATE_CONFIRMED
+    assert cache.get(_callback_cache_key(payment, captured))
+
+
+@pytest.mark.django_db
+def test_callback_not_deduplicated_on_failure(
+    quickpay_server, event, provider, provider_payment
+):
+    payment, captured = provider_payment()
+    # Without the provider's id stored, the payment has to be fetched
+    payment.info_data = {}
+    payment.save(update_fields=["info"])
+    quickpay_server.error_rate = 1
+    with scope(organizer=event.organizer):
+        with pytest.raises(Exception):
+            provider.handle_callback_payload(payment, captured)
+    # The provider's retry of the callback will be processed
+    assert cache.get(_callback_cache_key(payment, captured)) is None
+
+
+@pytest.mark.django_db
+def test_payment_lock_gives_up(monkeypatch, make_payment):
+    monkeypatch.setattr(payment_module, "PAYMENT_LOCK_WAIT", 0.2)
+    payment = make_payment()
+    with payment_module.payment_lock(payment):
+        with pytest.raises(payment_module.PaymentLockTimeout):
+            with payment_module.payment_lock(payment):
+                pass
+    # Released again
+    with payment_module.payment_lock(payment):
+        pass
+
+
+@pytest.mark.django_db
+def test_refresh_after_contended_lock(
+    quickpay_server, event, provider, provider_payment
+):
+    payment, captured = provider_payment()
+
+    def hold_lock():
+        # e.g. a callback whose payload is applied without fetching
+        with payment_module.payment_lock(payment):
+            time.sleep(0.3)
+
+    thread = threading.Thread(target=hold_lock)
+    thread.start()
+    time.sleep(0.05)
+    with scope(organizer=event.organizer):
+        provider.get_current_payment(payment)
+    thread.join()
+    assert quickpay_server.requests["GET /payments/{id}"] == 1
+    assert payment.state == OrderPayment.PAYMENT_STATE_CONFIRMED
+
+
+@pytest.fixture
+def created_payment(quickpay_server, provider_payment):
+    payment, captured = provider_payment()
+    return payment, json.dumps(captured).encode()
+
+
+def assert_not_processed(event, payment):
+    with scope(organizer=event.organizer):
+        payment.refresh_from_db()
+    assert payment.state == OrderPayment.PAYMENT_STATE_CREATED
+
+
+@pytest.mark.django_db
+def test_callback_too_large(
+    quickpay_server, event, provider, created_payment, rf, monkeypatch
+):
+    monkeypatch.setattr(payment_module, "CALLBACK_MAX_SIZE", 100)
+    payment, body = created_payment
+    with scope(organizer=event.organizer):
+        provider.handle_callback(callback_request(rf, body), payment)
+    assert_not_processed(event, payment)
+
+
+@pytest.mark.django_db
+def test_callback_too_large_without_content_length(
+    quickpay_server, event, provider, created_payment, rf, monkeypatch
+):
+    monkeypatch.setattr(payment_module, "CALLBACK_MAX_SIZE", 100)
+    payment, body = created_payment
+    request = callback_request(rf, body)
+    del request.META["CONTENT_LENGTH"]
+    with scope(organizer=event.organizer):
+        provider.handle_callback(request, payment)
+    assert_not_processed(event, payment)
+
+
+@pytest.mark.django_db
+def test_callback_invalid_checksum(
+    quickpay_server, event, provider, created_payment, rf, caplog, monkeypatch
+):
+    monkeypatch.setattr(payment_module, "CALLBACK_LOG_SIZE", 10)
+    payment, body = created_payment
+    with scope(organizer=event.organizer):
+        provider.handle_callback(callback_request(rf, body, key=b"wrong"), payment)
+    assert_not_processed(event, payment)
+    # Only the beginning of the payload is logged
+    assert repr(body[:10]) in caplog.text
+    assert repr(body[:11]) not in caplog.text
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize("body", [b"not json", b"[1, 2, 3]"])
+def test_callback_invalid_payload(
+    quickpay_server, event, provider, created_payment, rf, body
+):
+    payment, _ = created_payment
+    with scope(organizer=event.organizer):
+        provider.handle_callback(callback_request(rf, body), payment)
+    assert_not_processed(event, payment)
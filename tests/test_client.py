@@ -0,0 +1,133 @@
+import asyncio
+import pytest
+import time
+from quickpay_api_client.exceptions import ApiError
+
+from pretix_quickpay import client
+
+
+@pytest.fixture
+def provider_id(quickpay_server):
+    return quickpay_server.create_payment("FOO00001-P-1", "EUR")["id"]
+
+
+def test_get_retried(quickpay_server, provider_id):
+    quickpay_server.failures = 2
+    payment = client.get_client("apikey").get("/payments/%s" % provider_id)
+    assert payment["id"] == provider_id
+    assert quickpay_server.requests["GET /payments/{id}"] == 3
+
+
+def test_post_not_retried(quickpay_server):
+    quickpay_server.failures = 1
+    with pytest.raises(ApiError):
+        client.get_client("apikey").post(
+            "/payments", body={"order_id": "FOO00001-P-1", "currency": "EUR"}
+        )
+    assert quickpay_server.requests["POST /payments"] == 1
+
+
+def test_client_error_not_retried(quickpay_server):
+    with pytest.raises(ApiError) as e:
+        client.get_client("apikey").get("/payments/1")
+    assert e.value.status_code == 404
+    assert quickpay_server.requests["GET /payments/{id}"] == 1
+
+
+def test_circuit_breaker(quickpay_server, provider_id):
+    quickpay_server.failures = client.CIRCUIT_BREAKER_THRESHOLD
+    c = client.get_client("apikey")
+    for _ in range(client.CIRCUIT_BREAKER_THRESHOLD):
+        with pytest.raises(ApiError):
+            c.post("/payments", body={"order_id": "FOO00001-P-2", "currency": "EUR"})
+    with pytest.raises(client.CircuitOpenError):
+        c.get("/payments/%s" % provider_id)
+    assert quickpay_server.requests["GET /payments/{id}"] == 0
+
+
+def test_circuit_breaker_per_credential(quickpay_server, provider_id):
+    quickpay_server.failures = client.CIRCUIT_BREAKER_THRESHOLD
+    for _ in range(client.CIRCUIT_BREAKER_THRESHOLD):
+        with pytest.raises(ApiError):
+            client.get_client("apikey").post(
+                "/payments", body={"order_id": "FOO00001-P-2", "currency": "EUR"}
+            )
+    payment = client.get_client("other").get("/payments/%s" % provider_id)
+    assert payment["id"] == provider_id
+
+
+def test_rate_limit_retried_without_opening_circuit(quickpay_server, provider_id):
+    quickpay_server.failure_status = 429
+    quickpay_server.failures = client.CIRCUIT_BREAKER_THRESHOLD
+    c = client.get_client("apikey")
+    for _ in range(client.CIRCUIT_BREAKER_THRESHOLD - 1):
+        with pytest.raises(ApiError):
+            c.post("/payments", body={"order_id": "FOO00001-P-2", "currency": "EUR"})
+    assert c.get("/payments/%s" % provider_id)["id"] == provider_id
+    assert quickpay_server.requests["GET /payments/{id}"] == 2
+
+
+def test_deadline(quickpay_server, provider_id, monkeypatch):
+    monkeypatch.setattr(client, "CALL_DEADLINE", 0.5)
+    quickpay_server.latency = 2
+    start = time.monotonic()
+    with pytest.raises(Exception):
+        client.get_client("apikey").get("/payments/%s" % provider_id)
+    assert time.monotonic() - start < 1.5
+
+
+def run_async(coro_func):
+    pytest.importorskip("aiohttp")
+
+    async def run():
+        async with client.AsyncProviderClient("apikey") as c:
+            return await coro_func(c)
+
+    return asyncio.run(run())
+
+
+def test_async_get_retried(quickpay_server, provider_id):
+    quickpay_server.failures = 2
+
+    async def get(c):
+        return await c.get("/payments/%s" % provider_id)
+
+    assert run_async(get)["id"] == provider_id
+    assert quickpay_server.requests["GET /payments/{id}"] == 3
+
+
+def test_async_post_not_retried(quickpay_server):
+    quickpay_server.failures = 1
+
+    async def post(c):
+        return await c.post(
+            "/payments", body={"order_id": "FOO00001-P-1", "currency": "EUR"}
+        )
+
+    with pytest.raises(ApiError):
+        run_async(post)
+    assert quickpay_server.requests["POST /payments"] == 1
+
+
+def test_async_concurrent(quickpay_server, provider_id):
+    quickpay_server.latency = 0.2
+
+    async def get_many(c):
+        return await asyncio.gather(
+            *(c.get("/payments/%s" % provider_id) for _ in range(10))
+        )
+
+    results = run_async(get_many)
+    assert [r["id"] for r in results] == [provider_id] * 10
+    # The requests were in flight at the same time
+    assert quickpay_server.max_in_flight > 1
+
+
+def test_async_raw(quickpay_server, provider_id):
+    async def refund(c):
+        return await c.post(
+            "/payments/%s/refund" % provider_id, body={"amount": 100}, raw=True
+        )
+
+    status, body, headers = run_async(refund)
+    assert status == 202
@@ -0,0 +1,46 @@
+import json
+import os
+import pytest
+import subprocess
+import sys
+
+IMPORT_SCRIPT = """
+import json, sys, time
+import django
+django.setup()
+import pretix.base.forms, pretix.base.models, pretix.base.payment  # NOQA
+start = time.perf_counter()
+import pretix_quickpay.paymentmethods, pretix_unzerdirect.paymentmethods  # NOQA
+print(json.dumps({
+    "duration": time.perf_counter() - start,
+    "modules": sorted(sys.modules),
+}))
+"""
+
+
+@pytest.fixture(scope="module")
+def plugin_import():
+    output = subprocess.run(
+        [sys.executable, "-c", IMPORT_SCRIPT],
+        check=True,
+        capture_output=True,
+        env=dict(os.environ, DJANGO_SETTINGS_MODULE="pretix.testutils.settings"),
+        text=True,
+    ).stdout
+    return json.loads(output.splitlines()[-1])
+
+
+def test_import_is_lazy(plugin_import):
+    # The provider client and the tasks are only loaded once they are used
+    assert "quickpay_api_client" not in plugin_import["modules"]
+    assert "pretix_quickpay.tasks" not in plugin_import["modules"]
+
+
+@pytest.mark.skipif(
+    "QUICKPAY_IMPORT_TIME_BUDGET" not in os.environ,
+    reason="Set QUICKPAY_IMPORT_TIME_BUDGET (in seconds) to check the import time",
+)
+def test_import_time(plugin_import):
+    # Wall-clock time depends on the machine, so the budget is set where it is run
+    budget = float(os.environ["QUICKPAY_IMPORT_TIME_BUDGET"])
+    assert plugin_import["duration"] < budget
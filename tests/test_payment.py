@@ -0,0 +1,63 @@
+import pytest
+from decimal import Decimal
+from django_scopes import scope
+from pretix.base.payment import BasePaymentProvider
+
+from pretix_quickpay.payment import compact_payment_info
+
+
+@pytest.fixture
+def allowed_by_pretix(monkeypatch):
+    # Only the plugin's own constraints are tested here
+    monkeypatch.setattr(BasePaymentProvider, "is_allowed", lambda *args: True)
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize(
+    "method,currency,allowed",
+    [
+        ("visa", "EUR", True),
+        ("visa", "SEK", True),
+        ("swish", "SEK", True),
+        ("swish", "EUR", False),
+        ("vipps", "NOK", True),
+        ("vipps", "DKK", False),
+        ("ideal", "EUR", True),
+        ("ideal", "DKK", False),
+        ("mobilepay", "DKK", True),
+        ("mobilepay", "SEK", False),
+    ],
+)
+def test_is_allowed_currency(event, allowed_by_pretix, rf, method, currency, allowed):
+    event.currency = currency
+    event.save()
+    with scope(organizer=event.organizer):
+        provider = event.get_payment_providers()["quickpay_{}".format(method)]
+        assert provider.is_allowed(rf.get("/"), Decimal("23.00")) is allowed
+
+
+@pytest.mark.django_db
+def test_is_allowed_amount(event, allowed_by_pretix, rf, monkeypatch):
+    with scope(organizer=event.organizer):
+        provider = event.get_payment_providers()["quickpay_visa"]
+        monkeypatch.setattr(provider, "min_amount", Decimal("10.00"))
+        monkeypatch.setattr(provider, "max_amount", Decimal("100.00"))
+        assert provider.is_allowed(rf.get("/"), Decimal("23.00"))
+        assert not provider.is_allowed(rf.get("/"), Decimal("5.00"))
+        assert not provider.is_allowed(rf.get("/"), Decimal("500.00"))
+        # Without a total only the currency is checked
+        assert provider.is_allowed(rf.get("/"))
+
+
+@pytest.mark.django_db
+def test_control_render_compact_info(
+    quickpay_server, event, provider, provider_payment, rf
+):
+    payment, captured = provider_payment()
+    quickpay_server.add_operation(payment.info_data["id"], "refund", 1000)
+    refunded = quickpay_server.add_operation(payment.info_data["id"], "refund", 1300)
+    with scope(organizer=event.organizer):
+        payment.info_data = compact_payment_info(refunded)
+        html = provider.payment_control_render(rf.get("/"), payment)
+    assert "Last operation 3" in html
+    assert "<dd>3</dd>" in html
@@ -0,0 +1,69 @@
+import pytest
+from django_scopes import scope, scopes_disabled
+from pretix.base.models import Event
+
+
+@pytest.fixture
+def precreating_provider(event, provider):
+    event.settings.set("payment_quickpay_precreate_payments", True)
+    return provider
+
+
+@pytest.fixture
+def session_request(rf):
+    request = rf.get("/")
+    request.session = {}
+    return request
+
+
+@pytest.mark.django_db
+def test_precreated_payment_used(
+    quickpay_server, event, precreating_provider, make_payment, session_request
+):
+    with scope(organizer=event.organizer):
+        precreating_provider.checkout_confirm_render(session_request)
+        # Rendering the page again does not prepare another payment
+        precreating_provider.checkout_confirm_render(session_request)
+        assert quickpay_server.requests["POST /payments"] == 1
+        precreating_provider.execute_payment(session_request, make_payment())
+    assert quickpay_server.requests["POST /payments"] == 1
+    assert quickpay_server.requests["PUT /payments/{id}/link"] == 1
+    assert not session_request.session
+
+
+@pytest.mark.django_db
+def test_precreated_payment_other_event(
+    quickpay_server, event, precreating_provider, make_payment, session_request
+):
+    with scopes_disabled():
+        other_event = Event.objects.create(
+            organizer=event.organizer,
+            name="Other",
+            slug="other",
+            date_from=event.date_from,
+            currency="EUR",
+            plugins="pretix_quickpay",
+            live=True,
+        )
+    with scope(organizer=event.organizer):
+        other_event.settings.set("payment_quickpay_precreate_payments", True)
+        other_event.settings.set("payment_quickpay_apikey", "otherkey")
+        other_provider = other_event.get_payment_providers()["quickpay_visa"]
+        other_provider.checkout_confirm_render(session_request)
+        precreating_provider.execute_payment(session_request, make_payment())
+    # The payment of the other event's merchant account is not used
+    assert quickpay_server.requests["POST /payments"] == 2
+    assert quickpay_server.requests["PUT /payments/{id}/link"] == 1
+
+
+@pytest.mark.django_db
+def test_precreation_skipped_without_cache(
+    quickpay_server, event, precreating_provider, session_request, settings
+):
+    settings.CACHES = {
+        "default": {"BACKEND": "django.core.cache.backends.dummy.DummyCache"}
+    }
+    with scope(organizer=event.organizer):
+        precreating_provider.checkout_confirm_render(session_request)
+    assert quickpay_server.requests["POST /payments"] == 0
+    assert not session_request.session
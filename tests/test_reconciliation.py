@@ -0,0 +1,133 @@
+import pytest
+from datetime import timedelta
+from django.core.management import call_command
+from django.utils.timezone import now
+from django_scopes import scopes_disabled
+from pretix.base.models import OrderPayment
+
+from pretix_quickpay.payment import compact_payment_info
+from pretix_quickpay.reconciliation import (
+    pending_payments,
+    reconcile_payments,
+    sync_payments_by_listing,
+)
+
+
+def refreshed(payments):
+    with scopes_disabled():
+        return [OrderPayment.objects.get(pk=p.pk) for p in payments]
+
+
+@pytest.mark.django_db
+def test_reconcile_payments(quickpay_server, provider, provider_payment):
+    payments = [provider_payment()[0] for _ in range(5)]
+    with scopes_disabled():
+        stats = reconcile_payments(pending_payments(), workers=2, rate=0)
+    assert stats["total"] == 5
+    assert stats["changed"] == 5
+    assert quickpay_server.requests["GET /payments/{id}"] == 5
+    assert all(
+        p.state == OrderPayment.PAYMENT_STATE_CONFIRMED for p in refreshed(payments)
+    )
+
+
+@pytest.mark.django_db
+def test_reconcile_payments_asyncio(quickpay_server, provider, provider_payment):
+    pytest.importorskip("aiohttp")
+    payments = [provider_payment()[0] for _ in range(5)]
+    with scopes_disabled():
+        stats = reconcile_payments(
+            pending_payments(), workers=2, rate=0, use_asyncio=True
+        )
+    assert stats["changed"] == 5
+    assert all(
+        p.state == OrderPayment.PAYMENT_STATE_CONFIRMED for p in refreshed(payments)
+    )
+
+
+@pytest.mark.django_db
+def test_reconcile_command(quickpay_server, event, provider, provider_payment):
+    payments = [provider_payment()[0] for _ in range(3)]
+    call_command("quickpay_reconcile", event=event.slug, rate=0)
+    assert all(
+        p.state == OrderPayment.PAYMENT_STATE_CONFIRMED for p in refreshed(payments)
+    )
+
+
+@pytest.mark.django_db
+def test_sync_payments_by_listing(quickpay_server, event, provider, make_payment):
+    payments = [make_payment() for _ in range(5)]
+    for payment in payments:
+        # The creation response got lost, so we don't know the provider's id
+        created = quickpay_server.create_payment(payment.full_id, "EUR")
+        quickpay_server.add_operation(created["id"], "capture", 2300)
+    with scopes_disabled():
+        stats = sync_payments_by_listing(
+            [event], "quickpay", now() - timedelta(days=1), page_size=2
+        )
+    assert stats == {"total": 5, "matched": 5, "changed": 5}
+    assert quickpay_server.requests["GET /payments"] == 3
+    for payment in refreshed(payments):
+        assert payment.state == OrderPayment.PAYMENT_STATE_CONFIRMED
+        assert payment.info_data["id"]
+
+
+@pytest.mark.django_db
+def test_sync_payments_by_listing_keeps_newer(
+    quickpay_server, event, provider, provider_payment
+):
+    payment, captured = provider_payment()
+    # A callback applied a newer state after the listing was requested
+    newer = dict(compact_payment_info(captured), operation_count=2)
+    with scopes_disabled():
+        payment.info_data = newer
+        payment.save(update_fields=["info"])
+        stats = sync_payments_by_listing([event], "quickpay", now() - timedelta(days=1))
+    assert stats["changed"] == 0
+    assert refreshed([payment])[0].info_data == newer
+
+
+@pytest.mark.django_db
+def test_reconcile_listing_command(quickpay_server, event, provider, make_payment):
+    payment = make_payment()
+    created = quickpay_server.create_payment(payment.full_id, "EUR")
+    quickpay_server.add_operation(created["id"], "capture", 2300)
+    call_command("quickpay_reconcile", listing=True, event=event.slug)
+    assert refreshed([payment])[0].state == OrderPayment.PAYMENT_STATE_CONFIRMED
+
+
+@pytest.mark.django_db
+def test_reconcile_listing_command_per_account(
+    quickpay_server, event, provider, make_payment
+):
+    with scopes_disabled():
+        other = event.organizer.events.create(
+            name="Other",
+            slug="other",
+            date_from=now(),
+            currency="EUR",
+            plugins="pretix_quickpay",
+        )
+        other.settings.set("payment_quickpay_apikey", "apikey")
+    payment = make_payment()
+    created = quickpay_server.create_payment(payment.full_id, "EUR")
+    quickpay_server.add_operation(created["id"], "capture", 2300)
+    with scopes_disabled():
+        other.orders.create(
+            code="BAR00001",
+            email="dummy@dummy.test",
+            sales_channel=payment.order.sales_channel,
+            status=payment.order.status,
+            datetime=now(),
+            expires=payment.order.expires,
+            total=payment.amount,
+        ).payments.create(
+            provider="quickpay_visa",
+            amount=payment.amount,
+            state=OrderPayment.PAYMENT_STATE_CREATED,
+        )
+    call_command("quickpay_reconcile", listing=True)
+    # Both events use the same merchant account, which is listed once, and no
+    # other brand is listed without an API key
+    assert quickpay_server.requests["GET /payments"] == 1
+    assert refreshed([payment])[0].state == OrderPayment.PAYMENT_STATE_CONFIRMED
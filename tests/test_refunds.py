@@ -0,0 +1,158 @@
+import json
+import pytest
+from decimal import Decimal
+from django.core.management import call_command
+from django_scopes import scope, scopes_disabled
+from pretix.base.models import OrderRefund
+
+from pretix_quickpay.reconciliation import execute_refunds, pending_refunds
+
+
+@pytest.fixture
+def make_refund(provider, provider_payment):
+    @scopes_disabled()
+    def make_refund(state=OrderRefund.REFUND_STATE_CREATED):
+        payment, captured = provider_payment()
+        payment.info_data = captured
+        payment.save(update_fields=["info"])
+        return payment.order.refunds.create(
+            payment=payment,
+            source=OrderRefund.REFUND_SOURCE_ADMIN,
+            state=state,
+            amount=payment.amount,
+            provider=payment.provider,
+        )
+
+    return make_refund
+
+
+def refund_states(refunds):
+    with scopes_disabled():
+        return [OrderRefund.objects.get(pk=r.pk).state for r in refunds]
+
+
+@pytest.mark.django_db
+def test_execute_refunds(quickpay_server, make_refund):
+    refunds = [make_refund() for _ in range(5)]
+    with scopes_disabled():
+        stats = execute_refunds(pending_refunds(), workers=2, rate=0)
+        assert (
+            refunds[0]
+            .order.all_logentries()
+            .filter(action_type="pretix_quickpay.event")
+            .exists()
+        )
+    assert stats["total"] == 5
+    assert stats["accepted"] == 5
+    assert quickpay_server.requests["POST /payments/{id}/refund"] == 5
+    # The stub finishes refund operations right away
+    assert refund_states(refunds) == [OrderRefund.REFUND_STATE_DONE] * 5
+
+
+@pytest.mark.django_db
+def test_execute_refunds_only_once(quickpay_server, make_refund):
+    refunds = [make_refund() for _ in range(3)]
+    with scopes_disabled():
+        # Both runs see the refunds as created, only one of them may submit them
+        first = list(pending_refunds())
+        second = list(pending_refunds())
+        execute_refunds(first, rate=0)
+        stats = execute_refunds(second, rate=0)
+    assert stats["skipped"] == 3
+    assert quickpay_server.requests["POST /payments/{id}/refund"] == 3
+    assert refund_states(refunds) == [OrderRefund.REFUND_STATE_DONE] * 3
+
+
+@pytest.mark.django_db
+def test_execute_refunds_errors(quickpay_server, make_refund):
+    quickpay_server.error_rate = 1
+    refunds = [make_refund() for _ in range(3)]
+    with scopes_disabled():
+        stats = execute_refunds(pending_refunds(), rate=0)
+        assert (
+            refunds[0]
+            .order.all_logentries()
+            .filter(action_type="pretix.event.order.refund.failed")
+            .exists()
+        )
+        assert not pending_refunds().exists()
+    assert stats["errors"] == 3
+    # The provider may have received them, so they are not submitted again
+    assert refund_states(refunds) == [OrderRefund.REFUND_STATE_FAILED] * 3
+
+
+@pytest.mark.django_db
+def test_execute_refunds_unsent(quickpay_server, make_refund):
+    refunds = [make_refund() for _ in range(3)]
+    quickpay_server.stop()
+    with scopes_disabled():
+        stats = execute_refunds(pending_refunds(), rate=0)
+        # The connection was refused, so they can be submitted again
+        assert pending_refunds().count() == 3
+    assert stats["unsent"] == 3
+    assert stats["errors"] == 0
+    assert refund_states(refunds) == [OrderRefund.REFUND_STATE_CREATED] * 3
+
+
+@pytest.mark.django_db
+def test_execute_refund_claimed(quickpay_server, event, provider, make_refund):
+    refund = make_refund()
+    with scopes_disabled():
+        execute_refunds(pending_refunds(), rate=0)
+    with scope(organizer=event.organizer):
+        provider.execute_refund(refund)
+    assert quickpay_server.requests["POST /payments/{id}/refund"] == 1
+
+
+@pytest.mark.django_db
+def test_refund_command(quickpay_server, event, make_refund):
+    refunds = [make_refund() for _ in range(2)]
+    make_refund(state=OrderRefund.REFUND_STATE_DONE)
+    call_command("quickpay_refund", event=event.slug, rate=0)
+    assert quickpay_server.requests["POST /payments/{id}/refund"] == 2
+    assert refund_states(refunds) == [OrderRefund.REFUND_STATE_DONE] * 2
+
+
+@pytest.mark.django_db
+def test_refund_resolved_with_unchanged_payment(
+    quickpay_server, event, provider, make_refund
+):
+    refund = make_refund()
+    payment = refund.payment
+    refunded = quickpay_server.add_operation(payment.info_data["id"], "refund", 2300)
+    with scope(organizer=event.organizer):
+        # The finished operation arrives before the refund is put in transit
+        provider.apply_payment_info(payment, refunded)
+        refund.state = OrderRefund.REFUND_STATE_TRANSIT
+        refund.save(update_fields=["state"])
+        assert not provider.apply_payment_info(payment, refunded)
+        refund.refresh_from_db()
+    assert refund.state == OrderRefund.REFUND_STATE_DONE
+
+
+@pytest.mark.django_db
+def test_refund_not_matched_to_earlier_refund(
+    quickpay_server, event, provider, provider_payment
+):
+    payment, captured = provider_payment()
+    refunded = quickpay_server.add_operation(payment.info_data["id"], "refund", 1000)
+    with scopes_disabled():
+        payment.info_data = captured
+        payment.save(update_fields=["info"])
+        for state, info in (
+            (OrderRefund.REFUND_STATE_DONE, {"refund_operation_id": 2}),
+            (OrderRefund.REFUND_STATE_TRANSIT, {}),
+        ):
+            refund = payment.order.refunds.create(
+                payment=payment,
+                source=OrderRefund.REFUND_SOURCE_ADMIN,
+                state=state,
+                amount=Decimal("10.00"),
+                provider=payment.provider,
+                info=json.dumps(info),
+            )
+    with scope(organizer=event.organizer):
+        # Only the operation of the first refund is finished so far
+        provider.apply_payment_info(payment, refunded)
+        refund.refresh_from_db()
+    assert refund.state == OrderRefund.REFUND_STATE_TRANSIT
@@ -0,0 +1,68 @@
+import hashlib
+import pytest
+from django_scopes import scopes_disabled
+
+
+@pytest.fixture
+def payment(quickpay_server, make_payment):
+    payment = make_payment()
+    payment.info_data = quickpay_server.create_payment(payment.full_id, "EUR")
+    payment.save(update_fields=["info"])
+    return payment
+
+
+def status_url(payment, hash=None, pk=None):
+    order = payment.order
+    return "/{}/{}/quickpay/status/{}/{}/{}/".format(
+        order.event.organizer.slug,
+        order.event.slug,
+        order.code,
+        hash or hashlib.sha1(order.secret.lower().encode()).hexdigest(),
+        pk or payment.pk,
+    )
+
+
+@pytest.mark.django_db
+def test_status_view(client, payment):
+    response = client.get(status_url(payment))
+    assert response.status_code == 200
+    assert response.json() == {
+        "state": "created",
+        "provider_state": "initial",
+        "paid": False,
+    }
+
+
+@pytest.mark.django_db
+def test_status_view_refreshes(client, quickpay_server, payment):
+    quickpay_server.add_operation(payment.info_data["id"], "capture", 2300)
+    client.get(status_url(payment))
+    # The refresh happened in the background, the next poll sees its result
+    response = client.get(status_url(payment))
+    assert response.json() == {
+        "state": "confirmed",
+        "provider_state": "processed",
+        "paid": True,
+    }
+    assert quickpay_server.requests["GET /payments/{id}"] == 1
+
+
+@pytest.mark.django_db
+def test_status_view_wrong_hash(client, payment):
+    response = client.get(status_url(payment, hash="0" * 40))
+    assert response.status_code == 404
+
+
+@pytest.mark.django_db
+def test_status_view_unknown_payment(client, payment):
+    response = client.get(status_url(payment, pk=payment.pk + 1000))
+    assert response.status_code == 404
+
+
+@pytest.mark.django_db
+def test_status_view_other_brand(client, payment):
+    with scopes_disabled():
+        payment.provider = "unzerdirect_visa"
+        payment.save(update_fields=["provider"])
+    response = client.get(status_url(payment))
+    assert response.status_code == 404